@@ -0,0 +1,330 @@
+from __future__ import annotations
+import argparse
+from collections import OrderedDict
+import hashlib
+import sys
+from typing import TYPE_CHECKING, Dict, Iterator, List, Set, Tuple
+
+from instruction import OperationType, OperandType, decode_instruction
+from tools import *
+
+if TYPE_CHECKING:
+    from chip8 import Memory
+
+
+# Instructions after which execution continues at the next instruction or the one after it:
+SKIP_INSTRUCTIONS = {
+    OperationType.SKIP_IF_EQUALS,
+    OperationType.SKIP_IF_NOT_EQUALS,
+    OperationType.SKIP_IF_KEY_PRESSED,
+    OperationType.SKIP_IF_KEY_NOT_PRESSED,
+}
+
+
+class BasicBlock:
+
+    def __init__(self, start: int) -> None:
+        self.start = start
+        self.end = start # Address after the last instruction, wrapped around memory like every other address
+        self.length = 0
+
+        # Where execution can go after the last instruction. A CALL ends its block, and its successor is the address it
+        # returns to, with the subroutine in `call`:
+        self.successors: List[int] = []
+        self.call: int = None
+        self.returns = False
+
+        # Ends with JP V0, addr, whose target is only known at runtime:
+        self.dynamic = False
+
+
+    def __str__(self) -> str:
+        successors = ', '.join(to_hex(successor, 3) for successor in self.successors)
+        return f'BasicBlock({to_hex(self.start, 3)}-{to_hex(self.end, 3)}, {self.length} instructions, -> [{successors}])'
+
+
+class Analysis:
+
+    def __init__(self, image: bytes, entry: int, rom_end: int) -> None:
+        # Static analysis of a memory image, following every path from `entry`. Code that is only reached through
+        # JP V0, addr or that the program writes at runtime cannot be found, so the targets of those jumps are kept
+        # for whoever needs them:
+
+        self.image = image
+        self.size = len(image)
+        self.entry = entry
+        self.rom_end = rom_end
+
+        self.blocks: Dict[int, BasicBlock] = {}
+        self.block_starts: Dict[int, int] = {} # Start of the block of every reachable instruction
+
+        # Subroutine entries (the entry point counts as one) to the subroutines they call and the blocks they own:
+        self.calls: Dict[int, Set[int]] = {}
+        self.routine_blocks: Dict[int, List[int]] = {}
+
+        # Addresses of every JP V0, addr to its base address:
+        self.dynamic_jumps: Dict[int, int] = {}
+
+        self.jump_targets: Set[int] = set()
+        self.data_references: Set[int] = set() # Addresses loaded into I by reachable code
+
+        # One flag per byte of memory, set on both bytes of every reachable instruction:
+        self.code = bytearray(self.size)
+
+        self.instruction_starts = bytearray(self.size)
+        self.leaders: Set[int] = {entry}
+        self.routines: Set[int] = {entry}
+
+        self.find_instructions()
+        self.build_blocks()
+        self.build_call_graph()
+
+
+    def find_instructions(self) -> None:
+        # Walks every path once, marking instruction starts and the addresses where a basic block must begin:
+
+        image = self.image
+        size = self.size
+        pending = [self.entry]
+
+        while pending:
+            address = pending.pop()
+
+            while not self.instruction_starts[address]:
+                self.instruction_starts[address] = 1
+
+                instruction = decode_instruction(image[address], image[(address + 1) % size])
+                operation = instruction.type
+                next_address = (address + 2) % size
+
+                if operation == OperationType.ABSOLUTE_JUMP:
+                    self.jump_targets.add(instruction.nnn)
+                    self.leaders.add(instruction.nnn)
+                    pending.append(instruction.nnn)
+                    break
+
+                elif operation == OperationType.CALL_SUBROUTINE:
+                    self.routines.add(instruction.nnn)
+                    self.leaders.add(instruction.nnn)
+                    self.leaders.add(next_address)
+                    pending.append(instruction.nnn)
+
+                elif operation == OperationType.RETURN_FROM_SUBROUTINE:
+                    break
+
+                elif operation == OperationType.ABSOLUTE_JUMP_WITH_OFFSET:
+                    self.dynamic_jumps[address] = instruction.nnn
+                    break
+
+                elif operation in SKIP_INSTRUCTIONS:
+                    skip_address = (address + 4) % size
+                    self.leaders.add(next_address)
+                    self.leaders.add(skip_address)
+                    pending.append(skip_address)
+
+                elif operation == OperationType.COPY and instruction.operands[0].type == OperandType.INDEX:
+                    self.data_references.add(instruction.nnn)
+
+                # Execution wraps around the end of memory, which always starts a new block:
+                if next_address < address:
+                    self.leaders.add(next_address)
+
+                address = next_address
+
+
+    def build_blocks(self) -> None:
+        image = self.image
+        size = self.size
+
+        for start in self.leaders:
+            block = BasicBlock(start)
+            address = start
+
+            while True:
+                instruction = decode_instruction(image[address], image[(address + 1) % size])
+                operation = instruction.type
+                next_address = (address + 2) % size
+
+                self.code[address] = 1
+                self.code[(address + 1) % size] = 1
+                self.block_starts[address] = start
+                block.length += 1
+
+                if operation == OperationType.ABSOLUTE_JUMP:
+                    block.successors.append(instruction.nnn)
+                    break
+
+                elif operation == OperationType.CALL_SUBROUTINE:
+                    block.call = instruction.nnn
+                    block.successors.append(next_address)
+                    break
+
+                elif operation == OperationType.RETURN_FROM_SUBROUTINE:
+                    block.returns = True
+                    break
+
+                elif operation == OperationType.ABSOLUTE_JUMP_WITH_OFFSET:
+                    block.dynamic = True
+                    break
+
+                elif operation in SKIP_INSTRUCTIONS:
+                    block.successors.extend((next_address, (address + 4) % size))
+                    break
+
+                elif next_address in self.leaders:
+                    block.successors.append(next_address)
+                    break
+
+                address = next_address
+
+            block.end = (address + 2) % size
+            self.blocks[start] = block
+
+
+    def build_call_graph(self) -> None:
+        # The blocks of a subroutine are those reached from its entry without going into the subroutines it calls. A
+        # block can belong to several subroutines when they share code:
+
+        for routine in self.routines:
+            callees: Set[int] = set()
+            owned: List[int] = []
+            pending = [routine]
+            visited = {routine}
+
+            while pending:
+                block = self.blocks[pending.pop()]
+                owned.append(block.start)
+
+                if block.call is not None:
+                    callees.add(block.call)
+
+                for successor in block.successors:
+                    if successor not in visited:
+                        visited.add(successor)
+                        pending.append(successor)
+
+            self.calls[routine] = callees
+            self.routine_blocks[routine] = sorted(owned)
+
+
+    def callers(self, routine: int) -> Set[int]:
+        return {caller for caller, callees in self.calls.items() if routine in callees}
+
+
+    def is_code(self, address: int) -> bool:
+        return self.code[address % self.size] == 1
+
+
+    def is_data(self, address: int) -> bool:
+        # Bytes of the ROM that no reachable instruction covers:
+        return self.entry <= address < self.rom_end and not self.code[address]
+
+
+    def is_instruction_start(self, address: int) -> bool:
+        return self.instruction_starts[address % self.size] == 1
+
+
+    def block_containing(self, address: int) -> BasicBlock:
+        start = self.block_starts.get(address % self.size)
+        return None if start is None else self.blocks[start]
+
+
+    def data_ranges(self) -> Iterator[Tuple[int, int]]:
+        # Runs of ROM bytes that are not code, as (start, end):
+        start = None
+
+        for address in range(self.entry, self.rom_end):
+            if self.code[address]:
+                if start is not None:
+                    yield start, address
+                    start = None
+            elif start is None:
+                start = address
+
+        if start is not None:
+            yield start, self.rom_end
+
+
+    @property
+    def labels(self) -> Dict[int, str]:
+        labels: Dict[int, str] = {}
+
+        for address in self.data_references:
+            labels[address] = f'data_{to_hex(address, 3)}'
+
+        for base in self.dynamic_jumps.values():
+            labels[base] = f'table_{to_hex(base, 3)}'
+
+        for address in self.jump_targets:
+            labels[address] = f'loc_{to_hex(address, 3)}'
+
+        for address in self.routines:
+            labels[address] = f'sub_{to_hex(address, 3)}'
+
+        labels[self.entry] = 'start'
+
+        return labels
+
+
+# Analyses by ROM hash, least recently used first. They only depend on the ROM, so every machine running it shares one:
+_analyses: OrderedDict = OrderedDict()
+
+
+def analyze(memory: Memory) -> Analysis:
+    # Works on the memory as it was loaded, not as the program left it:
+
+    rom_length = min(len(memory.rom.data), memory.size - memory.bytes_reserved)
+    key = (hashlib.sha1(memory.rom.data[:rom_length]).digest(), memory.size, memory.bytes_reserved)
+    analysis = _analyses.get(key)
+
+    if analysis is not None:
+        _analyses.move_to_end(key)
+        return analysis
+
+    analysis = Analysis(memory.initial_contents, memory.bytes_reserved, memory.bytes_reserved + rom_length)
+    _analyses[key] = analysis
+
+    if len(_analyses) > ANALYSIS_CACHED_ROMS:
+        _analyses.popitem(last=False)
+
+    return analysis
+
+
+def main(argv: List[str] = None) -> int:
+    from chip8 import MachineState, Memory, Rom
+
+    parser = argparse.ArgumentParser(description='Print the basic blocks, call graph and code/data split of a ROM.')
+    parser.add_argument('rom', help='ROM file to analyze')
+    parser.add_argument('--blocks', action='store_true', help='also list every basic block')
+    args = parser.parse_args(argv)
+
+    rom = Rom(args.rom)
+
+    if not rom.data:
+        parser.error(f'cannot read ROM "{args.rom}"')
+
+    analysis = analyze(Memory(MachineState(), rom))
+    labels = analysis.labels
+    code_bytes = sum(analysis.code[analysis.entry:analysis.rom_end])
+
+    print(f'{len(analysis.blocks)} blocks, {len(analysis.routines)} routines, {code_bytes} code bytes and {analysis.rom_end - analysis.entry - code_bytes} data bytes')
+
+    for routine in sorted(analysis.routines):
+        callees = ', '.join(labels[callee] for callee in sorted(analysis.calls[routine]))
+        print(f'{labels[routine]}: {len(analysis.routine_blocks[routine])} blocks, calls [{callees}]')
+
+    for address, base in sorted(analysis.dynamic_jumps.items()):
+        print(f'{to_hex(address, 3)}: dynamic jump from {to_hex(base, 3)}')
+
+    for start, end in analysis.data_ranges():
+        print(f'{to_hex(start, 3)}-{to_hex(end, 3)}: data')
+
+    if args.blocks:
+        for start in sorted(analysis.blocks):
+            print(analysis.blocks[start])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
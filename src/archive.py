@@ -0,0 +1,228 @@
+from __future__ import annotations
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+from chip8 import Rom
+
+
+# File layout: a header, the ROM data back to back, and an index of (name, offset, length, SHA-1) entries at the end,
+# so archives can be written in a single pass. Integers are little-endian.
+ARCHIVE_MAGIC = b'CHIP8ARC'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = struct.Struct('<8sHIQ') # Magic, version, entry count, index offset
+ARCHIVE_ENTRY = struct.Struct('<HQI20s') # Name length, data offset, data length, SHA-1 (followed by the UTF-8 name)
+
+
+class ArchiveEntry:
+
+    def __init__(self, name: str, offset: int, length: int, sha1: bytes) -> None:
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.sha1 = sha1
+
+
+class RomArchive:
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self.entries: Dict[str, ArchiveEntry] = {}
+
+        self.file = open(filepath, 'rb')
+
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError(f'"{filepath}" is not a ROM archive')
+
+        self.view = memoryview(self.map)
+
+        try:
+            self.read_index()
+        except struct.error:
+            self.close()
+            raise ValueError(f'"{filepath}" is a truncated ROM archive')
+        except ValueError:
+            self.close()
+            raise
+
+
+    def read_index(self) -> None:
+        if len(self.view) < ARCHIVE_HEADER.size:
+            raise ValueError(f'"{self.filepath}" is not a ROM archive')
+
+        magic, version, count, offset = ARCHIVE_HEADER.unpack_from(self.view, 0)
+
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f'"{self.filepath}" is not a ROM archive')
+        elif version != ARCHIVE_VERSION:
+            raise ValueError(f'unsupported ROM archive version: {version}')
+
+        for _ in range(count):
+            name_length, data_offset, data_length, sha1 = ARCHIVE_ENTRY.unpack_from(self.view, offset)
+            offset += ARCHIVE_ENTRY.size
+
+            name = bytes(self.view[offset:offset + name_length]).decode('utf-8')
+            offset += name_length
+
+            if data_offset + data_length > len(self.view):
+                raise ValueError(f'ROM "{name}" is out of the archive bounds')
+
+            self.entries[name] = ArchiveEntry(name, data_offset, data_length, sha1)
+
+
+    def rom(self, name: str) -> Rom:
+        # The ROM data is a view of the mapped file, not a copy. It stays valid after the archive is closed, which only
+        # unmaps the file once every ROM taken from it is gone:
+
+        entry = self.entries.get(name)
+
+        if entry is None:
+            raise KeyError(f'no ROM named "{name}" in "{self.filepath}"')
+
+        return Rom.from_bytes(self.view[entry.offset:entry.offset + entry.length])
+
+
+    def verify(self, name: str) -> bool:
+        entry = self.entries[name]
+        return hashlib.sha1(self.view[entry.offset:entry.offset + entry.length]).digest() == entry.sha1
+
+
+    def close(self) -> None:
+        self.view.release()
+
+        # Views of ROMs still in use keep the map alive, and it's unmapped when the last of them is released:
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+        self.map = None
+        self.file.close()
+
+
+    def __enter__(self) -> RomArchive:
+        return self
+
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+    def __iter__(self) -> Iterator[ArchiveEntry]:
+        return iter(self.entries.values())
+
+
+def write_archive(filepath: str, roms: List[Tuple[str, bytes]]) -> None:
+    # Names are how ROMs are looked up, so two with the same one are an error, checked before anything is written:
+
+    names = set()
+
+    for name, _ in roms:
+        if name in names:
+            raise ValueError(f'duplicate ROM name "{name}"')
+
+        names.add(name)
+
+    index = []
+
+    with open(filepath, 'wb') as archive_file:
+        archive_file.write(bytes(ARCHIVE_HEADER.size))
+
+        for name, data in roms:
+            index.append((name.encode('utf-8'), archive_file.tell(), len(data), hashlib.sha1(data).digest()))
+            archive_file.write(data)
+
+        index_offset = archive_file.tell()
+
+        for name, offset, length, sha1 in index:
+            archive_file.write(ARCHIVE_ENTRY.pack(len(name), offset, length, sha1))
+            archive_file.write(name)
+
+        archive_file.seek(0)
+        archive_file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(index), index_offset))
+
+
+def find_roms(paths: List[str]) -> Iterator[Tuple[str, str]]:
+    # Yields (name, path) for every file, with the names of files found in directories relative to them:
+
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    filepath = os.path.join(directory, filename)
+                    yield os.path.relpath(filepath, path).replace(os.sep, '/'), filepath
+        else:
+            yield os.path.basename(path), path
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Pack CHIP-8 ROMs into a single indexed archive, or list one.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = commands.add_parser('pack', help='create an archive from ROM files and directories')
+    pack_parser.add_argument('archive', help='archive file to write')
+    pack_parser.add_argument('roms', nargs='+', help='ROM files, or directories to pack recursively')
+
+    list_parser = commands.add_parser('list', help='list the ROMs in an archive')
+    list_parser.add_argument('archive', help='archive file to read')
+    list_parser.add_argument('--verify', action='store_true', help='check every ROM against its SHA-1')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        roms = []
+
+        for name, filepath in find_roms(args.roms):
+            with open(filepath, 'rb') as rom_file:
+                roms.append((name, rom_file.read()))
+
+        try:
+            write_archive(args.archive, roms)
+        except ValueError as error:
+            parser.error(str(error))
+
+        print(f'{len(roms)} ROMs packed into {args.archive}')
+
+    elif args.command == 'list':
+        failures = 0
+
+        try:
+            archive = RomArchive(args.archive)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+        with archive:
+            for entry in archive:
+                status = ''
+
+                if args.verify:
+                    valid = archive.verify(entry.name)
+                    failures += 0 if valid else 1
+                    status = ' OK' if valid else ' CORRUPTED'
+
+                print(f'{entry.sha1.hex()} {entry.length:6d} {entry.name}{status}')
+
+        if failures:
+            print(f'{failures} corrupted ROMs', file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,545 @@
+from __future__ import annotations
+from typing import Callable, List, Union
+
+import numpy as np
+
+import chip8
+from instruction import OperandType, OperationType, decode_instruction
+from tools import *
+
+
+# Handlers of the batch engine, by operation and operand types, since some operations (LD, ADD, SE, SNE) come in forms
+# that work on different parts of the machine:
+BATCH_HANDLERS = {
+    (OperationType.CLEAR_SCREEN, ()): 'execute_clear_screen',
+    (OperationType.RETURN_FROM_SUBROUTINE, ()): 'execute_return_from_subroutine',
+    (OperationType.ABSOLUTE_JUMP, (OperandType.LITERAL,)): 'execute_absolute_jump',
+    (OperationType.CALL_SUBROUTINE, (OperandType.LITERAL,)): 'execute_call_subroutine',
+    (OperationType.SKIP_IF_EQUALS, (OperandType.REGISTER, OperandType.LITERAL)): 'execute_skip_if_equals_literal',
+    (OperationType.SKIP_IF_EQUALS, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_skip_if_equals_register',
+    (OperationType.SKIP_IF_NOT_EQUALS, (OperandType.REGISTER, OperandType.LITERAL)): 'execute_skip_if_not_equals_literal',
+    (OperationType.SKIP_IF_NOT_EQUALS, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_skip_if_not_equals_register',
+    (OperationType.COPY, (OperandType.REGISTER, OperandType.LITERAL)): 'execute_copy_literal',
+    (OperationType.COPY, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_copy_register',
+    (OperationType.COPY, (OperandType.INDEX, OperandType.LITERAL)): 'execute_copy_index',
+    (OperationType.ADD_WITHOUT_CARRY, (OperandType.REGISTER, OperandType.LITERAL)): 'execute_add_without_carry',
+    (OperationType.ADD_WITHOUT_CARRY, (OperandType.INDEX, OperandType.REGISTER)): 'execute_add_to_index',
+    (OperationType.BITWISE_OR, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_bitwise_or',
+    (OperationType.BITWISE_AND, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_bitwise_and',
+    (OperationType.BITWISE_XOR, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_bitwise_xor',
+    (OperationType.ADD_WITH_CARRY, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_add_with_carry',
+    (OperationType.SUBTRACTION_DIRECT, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_subtraction_direct',
+    (OperationType.SHIFT_RIGHT, (OperandType.REGISTER,)): 'execute_shift_right',
+    (OperationType.SUBTRACTION_REVERSE, (OperandType.REGISTER, OperandType.REGISTER)): 'execute_subtraction_reverse',
+    (OperationType.SHIFT_LEFT, (OperandType.REGISTER,)): 'execute_shift_left',
+    (OperationType.ABSOLUTE_JUMP_WITH_OFFSET, (OperandType.LITERAL,)): 'execute_absolute_jump_with_offset',
+    (OperationType.RANDOM_NUMBER, (OperandType.REGISTER, OperandType.LITERAL)): 'execute_random_number',
+    (OperationType.DRAW, (OperandType.REGISTER, OperandType.REGISTER, OperandType.LITERAL)): 'execute_draw',
+    (OperationType.SKIP_IF_KEY_PRESSED, (OperandType.REGISTER,)): 'execute_skip_if_key_pressed',
+    (OperationType.SKIP_IF_KEY_NOT_PRESSED, (OperandType.REGISTER,)): 'execute_skip_if_key_not_pressed',
+    (OperationType.GET_DELAY_TIMER, (OperandType.REGISTER,)): 'execute_get_delay_timer',
+    (OperationType.WAIT_FOR_KEY, (OperandType.REGISTER,)): 'execute_wait_for_key',
+    (OperationType.SET_DELAY_TIMER, (OperandType.REGISTER,)): 'execute_set_delay_timer',
+    (OperationType.SET_SOUND_TIMER, (OperandType.REGISTER,)): 'execute_set_sound_timer',
+    (OperationType.LOAD_FONT, (OperandType.REGISTER,)): 'execute_load_font',
+    (OperationType.BCD_CONVERSION, (OperandType.REGISTER,)): 'execute_bcd_conversion',
+    (OperationType.DUMP_REGISTERS_TO_MEMORY, (OperandType.REGISTER,)): 'execute_dump_registers_to_memory',
+    (OperationType.LOAD_REGISTER_FROM_MEMORY, (OperandType.REGISTER,)): 'execute_load_register_from_memory',
+}
+
+# Handler names, and the index in that list of the handler of every opcode, built on first use:
+_HANDLER_NAMES: List[str] = ['execute_nothing'] + sorted(set(BATCH_HANDLERS.values()))
+_HANDLER_TABLE: np.ndarray = None
+
+
+def handler_table() -> np.ndarray:
+    global _HANDLER_TABLE
+
+    if _HANDLER_TABLE is None:
+        table = np.zeros(0x10000, dtype=np.uint8)
+
+        for opcode in range(0x10000):
+            instruction = decode_instruction(opcode >> 8, opcode & 0xff)
+            name = BATCH_HANDLERS.get((instruction.type, tuple(operand.type for operand in instruction.operands)))
+
+            if name is not None:
+                table[opcode] = _HANDLER_NAMES.index(name)
+
+        _HANDLER_TABLE = table
+
+    return _HANDLER_TABLE
+
+
+Instances = Union[np.ndarray, slice]
+
+
+class BatchChip8:
+
+    def __init__(self, rom: chip8.Rom, count: int, seeds: np.ndarray = None) -> None:
+        # N machines running the same ROM in lockstep, each one a row of the arrays below. The layout follows
+        # MachineState, but with a machine per row so a handler can update every machine executing it at once:
+
+        template = chip8.Chip8(rom)
+        state = template.state
+
+        if state.display_width != 64:
+            raise ValueError(f'unsupported display width: {state.display_width}')
+
+        self.count = count
+        self.memory_size = state.memory_size
+        self.display_width = state.display_width
+        self.display_height = state.display_height
+        self.first_char = template.memory.first_char
+
+        self.ram = np.zeros((count, state.memory_size), dtype=np.uint8)
+        # Framebuffers have a spare row at the bottom for execute_draw(), which isn't part of the display:
+        self.framebuffer_rows = np.zeros((count, state.display_height + 1), dtype=np.uint64)
+        self.framebuffer = self.framebuffer_rows[:, :state.display_height]
+        self.stack = np.zeros((count, len(state.stack)), dtype=np.uint16)
+        self.v = np.zeros((count, len(state.v)), dtype=np.uint8)
+        self.index = np.zeros(count, dtype=np.uint16)
+        self.pc = np.zeros(count, dtype=np.uint16)
+        self.sp = np.zeros(count, dtype=np.uint8)
+        self.delay_timer = np.zeros(count, dtype=np.uint8)
+        self.sound_timer = np.zeros(count, dtype=np.uint8)
+        self.keys_pressed = np.zeros(count, dtype=np.uint16)
+        self.previous_keys_pressed = np.zeros(count, dtype=np.uint16)
+
+        # Machines stopped by a stack overflow, where Chip8 raises an OverflowError. They stay on the failing call, with
+        # their timers frozen, until they are reset or loaded, while the others go on:
+        self.halted = np.zeros(count, dtype=bool)
+        self.halted_count = 0
+
+        # Every machine has its own xorshift32 generator for RND, instead of the shared `random` module of Chip8:
+        self.random_state = np.zeros(count, dtype=np.uint32)
+        self.seed(np.arange(count) if seeds is None else seeds)
+
+        # All machines share the step count, so timers tick for all of them at the same time:
+        self.current_step = 0
+        self.steps_per_timer_tick = template.steps_per_timer_tick
+
+        self.all_instances = np.arange(count)
+        self.ram_offsets = self.all_instances * state.memory_size
+        self.framebuffer_offsets = self.all_instances * (state.display_height + 1)
+        self.table = handler_table()
+        self.handlers: List[Callable[[np.ndarray, np.ndarray], None]] = [getattr(self, name) for name in _HANDLER_NAMES]
+
+        # Freshly reset machines, for reset(), and a machine to unpack save states with:
+        self.initial_state = template.save_state()
+        self.scratch = template
+        self.reset()
+
+
+    def seed(self, seeds: np.ndarray, instances: Instances = slice(None)) -> None:
+        # Seeds are scrambled (golden ratio multiply), since xorshift needs a non-zero state and small seeds would
+        # start out with very few bits set:
+
+        scrambled = (np.asarray(seeds, dtype=np.uint64) * np.uint64(0x9e3779b1) + np.uint64(0x7f4a7c15)) & np.uint64(0xffffffff)
+        self.random_state[instances] = np.where(scrambled == 0, 1, scrambled)
+
+
+    def reset(self, instances: Instances = slice(None)) -> None:
+        self.load_state(self.initial_state, instances)
+
+
+    def step(self, keys_pressed: Union[int, np.ndarray] = None) -> None:
+        # Keys, for every machine or one mask for all of them:
+
+        if keys_pressed is not None:
+            self.keys_pressed[:] = keys_pressed
+
+        # Fetch:
+
+        instances = self.all_instances
+        pc = self.pc
+        ram = self.ram.reshape(-1)
+
+        opcodes = (ram[self.ram_offsets + pc].astype(np.uint16) << 8) | ram[self.ram_offsets + (pc + 1) % self.memory_size]
+        pc += 2
+        pc %= self.memory_size
+
+        # Decode, and execute every handler once for all the machines that reached it. Halted machines execute nothing
+        # and stay where they are:
+
+        handler_indexes = self.table[opcodes]
+
+        if self.halted_count:
+            halted = self.halted
+            pc[halted] = (pc[halted] - 2) % self.memory_size
+            handler_indexes[halted] = 0
+        counts = np.bincount(handler_indexes, minlength=len(self.handlers))
+
+        for handler_index in np.flatnonzero(counts):
+            if counts[handler_index] == self.count:
+                self.handlers[handler_index](instances, opcodes)
+            else:
+                selected = np.flatnonzero(handler_indexes == handler_index)
+                self.handlers[handler_index](selected, opcodes[selected])
+
+        # Keys:
+
+        self.previous_keys_pressed[:] = self.keys_pressed
+
+        # Timers, brought up to date on every step, which is when Chip8.sync_timers() would tick them too:
+
+        if self.current_step % self.steps_per_timer_tick == 0:
+            for timer in (self.delay_timer, self.sound_timer):
+                ticking = timer > 0
+
+                if self.halted_count:
+                    ticking &= ~self.halted
+
+                np.subtract(timer, 1, out=timer, where=ticking)
+
+        self.current_step += 1
+
+
+    def run(self, cycles: int, keys_pressed: Union[int, np.ndarray] = None) -> int:
+        if keys_pressed is not None:
+            self.keys_pressed[:] = keys_pressed
+
+        for _ in range(cycles):
+            self.step()
+
+        return cycles
+
+
+    def save_state(self, instance: int) -> bytes:
+        # One machine as a Chip8 save state, so it can be inspected, displayed or continued with chip8.Chip8:
+
+        state = chip8.MachineState()
+
+        np.asarray(state.ram)[:] = self.ram[instance]
+        np.asarray(state.framebuffer)[:] = self.framebuffer[instance]
+        np.asarray(state.stack)[:] = self.stack[instance]
+        np.asarray(state.v)[:] = self.v[instance]
+
+        state.words[CHIP8_WORD_INDEX] = int(self.index[instance])
+        state.words[CHIP8_WORD_PC] = int(self.pc[instance])
+        state.control[CHIP8_BYTE_SP] = int(self.sp[instance])
+        state.control[CHIP8_BYTE_DELAY_TIMER] = int(self.delay_timer[instance])
+        state.control[CHIP8_BYTE_SOUND_TIMER] = int(self.sound_timer[instance])
+
+        header = chip8.SAVE_STATE_HEADER.pack(
+            chip8.SAVE_STATE_MAGIC,
+            chip8.SAVE_STATE_VERSION,
+            state.size,
+            self.current_step,
+            self.current_step,
+            int(self.keys_pressed[instance]),
+            int(self.previous_keys_pressed[instance]))
+
+        return header + state.buffer
+
+
+    def load_state(self, data: bytes, instances: Instances = slice(None)) -> None:
+        # Loads a Chip8 save state into some or all of the machines. The step count is shared, so the loaded timers
+        # keep their values but tick along with the batch from then on:
+
+        machine = self.scratch
+        machine.load_state(data)
+        machine.sync_timers()
+
+        state = machine.state
+
+        self.ram[instances] = np.asarray(state.ram)
+        self.framebuffer[instances] = np.asarray(state.framebuffer)
+        self.stack[instances] = np.asarray(state.stack)
+        self.v[instances] = np.asarray(state.v)
+        self.index[instances] = state.words[CHIP8_WORD_INDEX]
+        self.pc[instances] = state.words[CHIP8_WORD_PC]
+        self.sp[instances] = state.control[CHIP8_BYTE_SP]
+        self.delay_timer[instances] = state.control[CHIP8_BYTE_DELAY_TIMER]
+        self.sound_timer[instances] = state.control[CHIP8_BYTE_SOUND_TIMER]
+        self.keys_pressed[instances] = machine.keys_pressed
+        self.previous_keys_pressed[instances] = machine.previous_keys_pressed
+        self.halted[instances] = False
+        self.halted_count = int(np.count_nonzero(self.halted))
+
+
+    def pixels(self, instance: int) -> np.ndarray:
+        # The display of one machine as a (height, width) array of 0 and 1, leftmost pixel in the highest bit:
+
+        rows = self.framebuffer[instance].astype('>u8').view(np.uint8).reshape(self.display_height, 8)
+        return np.unpackbits(rows, axis=1)
+
+
+    # Handlers get the machines that execute them and their opcodes. Machines are distinct within one call, so
+    # assignments through fancy indexing never collide:
+
+    def execute_nothing(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        pass
+
+
+    def execute_clear_screen(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.framebuffer[instances] = 0
+
+
+    def execute_return_from_subroutine(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        # An empty stack leaves the program counter where it is:
+
+        depth = self.sp[instances]
+        returning = depth > 0
+        instances, depth = instances[returning], depth[returning] - 1
+
+        self.sp[instances] = depth
+        self.pc[instances] = self.stack[instances, depth]
+
+
+    def execute_absolute_jump(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.pc[instances] = opcodes & 0x0fff
+
+
+    def execute_call_subroutine(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        # A full stack halts the machine, with the program counter back on the call that didn't happen:
+
+        depth = self.sp[instances]
+        full = depth == self.stack.shape[1]
+
+        if full.any():
+            overflowing = instances[full]
+            self.pc[overflowing] = (self.pc[overflowing] - 2) % self.memory_size
+            self.halted[overflowing] = True
+            self.halted_count = int(np.count_nonzero(self.halted))
+
+            calling = ~full
+            instances, depth, opcodes = instances[calling], depth[calling], opcodes[calling]
+
+        self.stack[instances, depth] = self.pc[instances]
+        self.sp[instances] = depth + 1
+        self.pc[instances] = opcodes & 0x0fff
+
+
+    def skip_if(self, instances: np.ndarray, condition: np.ndarray) -> None:
+        skipping = instances[condition]
+        self.pc[skipping] = (self.pc[skipping] + 2) % self.memory_size
+
+
+    def execute_skip_if_equals_literal(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.skip_if(instances, self.v[instances, (opcodes >> 8) & 0x0f] == (opcodes & 0xff))
+
+
+    def execute_skip_if_equals_register(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        self.skip_if(instances, v[instances, (opcodes >> 8) & 0x0f] == v[instances, (opcodes >> 4) & 0x0f])
+
+
+    def execute_skip_if_not_equals_literal(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.skip_if(instances, self.v[instances, (opcodes >> 8) & 0x0f] != (opcodes & 0xff))
+
+
+    def execute_skip_if_not_equals_register(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        self.skip_if(instances, v[instances, (opcodes >> 8) & 0x0f] != v[instances, (opcodes >> 4) & 0x0f])
+
+
+    def execute_copy_literal(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.v[instances, (opcodes >> 8) & 0x0f] = opcodes & 0xff
+
+
+    def execute_copy_register(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        v[instances, (opcodes >> 8) & 0x0f] = v[instances, (opcodes >> 4) & 0x0f]
+
+
+    def execute_copy_index(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.index[instances] = opcodes & 0x0fff
+
+
+    def execute_add_without_carry(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+        v[instances, x] = (v[instances, x] + (opcodes & 0xff)) & 0xff
+
+
+    def execute_add_to_index(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.index[instances] += self.v[instances, (opcodes >> 8) & 0x0f]
+
+
+    def execute_bitwise_or(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+        v[instances, x] |= v[instances, (opcodes >> 4) & 0x0f]
+
+
+    def execute_bitwise_and(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+        v[instances, x] &= v[instances, (opcodes >> 4) & 0x0f]
+
+
+    def execute_bitwise_xor(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+        v[instances, x] ^= v[instances, (opcodes >> 4) & 0x0f]
+
+
+    # The arithmetic handlers write VF and Vx in the same order as Chip8's, so they agree when x or y is F:
+
+    def execute_add_with_carry(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x, y = (opcodes >> 8) & 0x0f, (opcodes >> 4) & 0x0f
+
+        result = v[instances, x].astype(np.uint16) + v[instances, y]
+        v[instances, x] = result & 0xff
+
+        # VF is only set on a carry, and left alone otherwise:
+        v[instances[result > 0xff], 0x0f] = 0x01
+
+
+    def execute_subtraction_direct(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x, y = (opcodes >> 8) & 0x0f, (opcodes >> 4) & 0x0f
+
+        v[instances, 0x0f] = v[instances, x] >= v[instances, y]
+        v[instances, x] = v[instances, x] - v[instances, y]
+
+
+    def execute_shift_right(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+
+        v[instances, 0x0f] = v[instances, x] & 0x01
+        v[instances, x] = v[instances, x] >> 1
+
+
+    def execute_subtraction_reverse(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x, y = (opcodes >> 8) & 0x0f, (opcodes >> 4) & 0x0f
+
+        v[instances, 0x0f] = v[instances, x] < v[instances, y]
+        v[instances, x] = v[instances, y] - v[instances, x]
+
+
+    def execute_shift_left(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        v = self.v
+        x = (opcodes >> 8) & 0x0f
+
+        v[instances, 0x0f] = v[instances, x] >> 7
+        v[instances, x] = v[instances, x] << 1
+
+
+    def execute_absolute_jump_with_offset(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.pc[instances] = ((opcodes & 0x0fff) + self.v[instances, 0x00]) & 0x00ff
+
+
+    def execute_random_number(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        # One xorshift32 step of each machine's generator, keeping the top byte:
+
+        state = self.random_state[instances]
+        state ^= state << 13
+        state ^= state >> 17
+        state ^= state << 5
+        self.random_state[instances] = state
+
+        self.v[instances, (opcodes >> 8) & 0x0f] = (state >> 24) & opcodes & 0xff
+
+
+    def execute_draw(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        # Same clipping and wrapping as Display.draw_sprite(), for all the sprite rows of every machine at once:
+
+        v = self.v
+        width, height = self.display_width, self.display_height
+
+        x = v[instances, (opcodes >> 8) & 0x0f] % width
+        y = v[instances, (opcodes >> 4) & 0x0f] % height
+        rows = opcodes & 0x0f
+
+        v[instances, 0x0f] = 0x00
+
+        offsets = np.arange(int(rows.max(initial=0)))
+        addresses = (self.index[instances, None] + offsets) % self.memory_size
+        sprite = self.ram.reshape(-1)[self.ram_offsets[instances, None] + addresses].astype(np.uint64)
+
+        shift = width - 8 - x.astype(np.int64)[:, None]
+        bits = (sprite << np.maximum(shift, 0).astype(np.uint64)) >> np.maximum(-shift, 0).astype(np.uint64)
+
+        # The first column past the right edge wraps around to the left one:
+        wraps = (shift < 0) & (((sprite >> np.maximum(-shift - 1, 0).astype(np.uint64)) & np.uint64(1)) == 1)
+        bits |= np.where(wraps, np.uint64(1 << (width - 1)), np.uint64(0))
+
+        # And the first row past the bottom edge to the top one. Rows past that, or past the sprite, go to the spare
+        # row at the bottom of every framebuffer, with no bits, so they can't collide with the rows actually drawn:
+
+        target = y[:, None] + offsets
+        drawing = (offsets < rows[:, None]) & (target <= height)
+        target = np.where(drawing, target % height, height)
+        bits[~drawing] = 0
+
+        framebuffers = self.framebuffer_rows.reshape(-1)
+        locations = self.framebuffer_offsets[instances, None] + target
+        framebuffer_rows = framebuffers[locations]
+
+        framebuffers[locations] = framebuffer_rows ^ bits
+        v[instances[((framebuffer_rows & bits) != 0).any(axis=1)], 0x0f] = 0x01
+
+
+    def execute_skip_if_key_pressed(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.skip_if(instances, self.key_is_pressed(instances, opcodes))
+
+
+    def execute_skip_if_key_not_pressed(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.skip_if(instances, ~self.key_is_pressed(instances, opcodes))
+
+
+    def key_is_pressed(self, instances: np.ndarray, opcodes: np.ndarray) -> np.ndarray:
+        # Keys past F are never pressed, like the bits past 15 of Chip8.keys_pressed:
+
+        key = self.v[instances, (opcodes >> 8) & 0x0f]
+        return (key < 16) & (((self.keys_pressed[instances] >> np.minimum(key, 15)) & 0x01) == 1)
+
+
+    def execute_get_delay_timer(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.v[instances, (opcodes >> 8) & 0x0f] = self.delay_timer[instances]
+
+
+    def execute_wait_for_key(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        # Waits for a key to be released, and takes the lowest one if several were released at once:
+
+        keys_released = (self.previous_keys_pressed[instances] & ~self.keys_pressed[instances]).astype(np.int64)
+        released = keys_released != 0
+
+        lowest_key = np.log2(keys_released[released] & -keys_released[released]).astype(np.uint8)
+        self.v[instances[released], (opcodes[released] >> 8) & 0x0f] = lowest_key
+
+        waiting = instances[~released]
+        self.pc[waiting] = (self.pc[waiting] - 2) % self.memory_size
+
+
+    def execute_set_delay_timer(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.delay_timer[instances] = self.v[instances, (opcodes >> 8) & 0x0f]
+
+
+    def execute_set_sound_timer(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        self.sound_timer[instances] = self.v[instances, (opcodes >> 8) & 0x0f]
+
+
+    def execute_load_font(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        character = self.v[instances, (opcodes >> 8) & 0x0f] & 0x0f
+        self.index[instances] = self.first_char + 5 * character.astype(np.uint16)
+
+
+    def execute_bcd_conversion(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        number = self.v[instances, (opcodes >> 8) & 0x0f]
+        index = self.index[instances].astype(np.int64)
+
+        for offset, digit in enumerate((number // 100, (number // 10) % 10, number % 10)):
+            self.ram[instances, (index + offset) % self.memory_size] = digit
+
+
+    def execute_dump_registers_to_memory(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        last_register = (opcodes >> 8) & 0x0f
+        index = self.index[instances].astype(np.int64)
+
+        for register in range(int(last_register.max()) + 1):
+            dumping = register <= last_register
+            self.ram[instances[dumping], (index[dumping] + register) % self.memory_size] = self.v[instances[dumping], register]
+
+
+    def execute_load_register_from_memory(self, instances: np.ndarray, opcodes: np.ndarray) -> None:
+        last_register = (opcodes >> 8) & 0x0f
+        index = self.index[instances].astype(np.int64)
+
+        for register in range(int(last_register.max()) + 1):
+            loading = register <= last_register
+            self.v[instances[loading], register] = self.ram[instances[loading], (index[loading] + register) % self.memory_size]
@@ -0,0 +1,321 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List, TextIO
+
+import chip8
+from constants import *
+from headless import KeyScript
+from instruction import Instruction, decode_instruction
+
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARK_SEED = 1234
+BENCHMARK_BATCH_SIZE = 10000
+BENCHMARK_ROMS = {
+    'test-opcode': os.path.join(ROOT_DIRECTORY, 'test-roms', '3-test-opcode.ch8'),
+    'pong': os.path.join(ROOT_DIRECTORY, 'games', 'pong.rom'),
+}
+
+# Paddles going up and down, so the game doesn't settle in a loop:
+BENCHMARK_KEY_SCRIPT = '''
+    0 1
+ 3000 4
+ 6000 c
+ 9000 d
+12000 1c
+15000 4d
+18000 -
+'''
+
+
+class Result:
+
+    def __init__(self, value: float, unit: str, higher_is_better: bool = True) -> None:
+        self.value = value
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+
+
+    def to_dict(self) -> Dict:
+        return {'value': self.value, 'unit': self.unit, 'higher_is_better': self.higher_is_better}
+
+
+def best_time(function: Callable[[], None], repeat: int) -> float:
+    # The fastest of several runs, which is the one least disturbed by the rest of the host:
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def benchmark_decode(results: Dict[str, Result], repeat: int) -> None:
+    def decode_all() -> None:
+        for opcode in range(0x10000):
+            Instruction(opcode >> 8, opcode & 0xff)
+
+    def decode_all_cached() -> None:
+        for opcode in range(0x10000):
+            decode_instruction(opcode >> 8, opcode & 0xff)
+
+    decode_all_cached()
+
+    results['decode.instruction'] = Result(0x10000 / best_time(decode_all, repeat), 'opcodes/s')
+    results['decode.cached'] = Result(0x10000 / best_time(decode_all_cached, repeat), 'opcodes/s')
+
+
+def benchmark_steps(results: Dict[str, Result], repeat: int, steps: int) -> None:
+    key_script = KeyScript.parse(BENCHMARK_KEY_SCRIPT)
+    keys = [key_script.keys_at(step) for step in range(steps)]
+
+    for rom_name, rom_path in BENCHMARK_ROMS.items():
+        rom = chip8.Rom(rom_path)
+
+        for mode in chip8.ExecutionMode:
+            machines = []
+
+            def make() -> None:
+                random.seed(BENCHMARK_SEED)
+                machines.append(chip8.Chip8(rom, mode))
+
+            def step() -> None:
+                machine = machines[-1]
+
+                for step_keys in keys:
+                    machine.step(step_keys)
+
+            def run() -> None:
+                machine = machines[-1]
+                executed = 0
+
+                while executed < steps:
+                    chunk_end = key_script.next_change_after(executed) or steps
+                    executed += machine.run(min(chunk_end, steps) - executed, keys[executed])
+
+            for name, function in (('step', step), ('run', run)):
+                times = []
+
+                for _ in range(repeat):
+                    make()
+                    times.append(best_time(function, 1))
+
+                # run() fast-forwards through idle loops, whose skipped steps aren't instructions executed. Every run is
+                # seeded the same, so they all skip the same steps:
+                instructions = steps - machines[-1].skipped_steps
+                results[f'{name}.{rom_name}.{mode.name.lower()}'] = Result(instructions / min(times), 'instructions/s')
+
+
+def benchmark_batch(results: Dict[str, Result], repeat: int, steps: int) -> None:
+    # Many machines stepped in lockstep by the NumPy engine, counting the instructions of all of them:
+
+    import batch
+
+    key_script = KeyScript.parse(BENCHMARK_KEY_SCRIPT)
+    batch_steps = max(steps // 100, 1)
+
+    for rom_name, rom_path in BENCHMARK_ROMS.items():
+        machines = batch.BatchChip8(chip8.Rom(rom_path), BENCHMARK_BATCH_SIZE)
+
+        def run() -> None:
+            for step in range(batch_steps):
+                machines.step(key_script.keys_at(step))
+
+        times = []
+
+        for _ in range(repeat):
+            machines.reset()
+            times.append(best_time(run, 1))
+
+        results[f'batch.{rom_name}'] = Result(BENCHMARK_BATCH_SIZE * batch_steps / min(times), 'instructions/s')
+
+
+def benchmark_draw(results: Dict[str, Result], repeat: int, draws: int) -> None:
+    # Sprites drawn straight through the DRW handler, from the font and a full 15-row sprite:
+
+    machine = chip8.Chip8(chip8.Rom(None))
+    machine.memory.write(0x300, bytes([0xff, 0x81] * 7 + [0xff]))
+
+    cases = {
+        'font-aligned': (machine.memory.first_char, 0, 8, 5),
+        'font-unaligned': (machine.memory.first_char, 3, 5, 5),
+        'full-sprite': (0x300, 17, 9, 15),
+        'right-edge-wrap': (0x300, 60, 9, 15),
+        'bottom-edge-wrap': (0x300, 17, 28, 15),
+    }
+
+    for case, (index, x, y, rows) in cases.items():
+        instruction = decode_instruction(0xd0 | 0x01, 0x20 | rows)
+
+        def draw() -> None:
+            machine.index.set_to(index)
+            machine.registers[0x1].set_to(x)
+            machine.registers[0x2].set_to(y)
+
+            for _ in range(draws):
+                machine.execute_draw(instruction)
+
+        results[f'draw.{case}'] = Result(draws / best_time(draw, repeat), 'draws/s')
+
+    interpreted = decode_instruction(0xd1, 0x2f)
+
+    def interpret() -> None:
+        machine.index.set_to(0x300)
+        machine.registers[0x1].set_to(17)
+        machine.registers[0x2].set_to(9)
+
+        for _ in range(draws // 10):
+            machine.interpret(interpreted)
+
+    results['draw.interpreter'] = Result(draws // 10 / best_time(interpret, repeat), 'draws/s')
+
+
+def benchmark_ui(results: Dict[str, Result], repeat: int, frames: int) -> None:
+    # The UI needs pygame, drawing offscreen through SDL's dummy drivers:
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+    import pygame
+    import ui
+
+    pygame.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode(SCREEN_GEOMETRY, 0, 32)
+
+    random.seed(BENCHMARK_SEED)
+    machine = chip8.Chip8(chip8.Rom(BENCHMARK_ROMS['pong']))
+    machine.run(5000)
+
+    panel = ui.Panel(screen, machine)
+    panel.draw()
+
+    names: Dict[str, int] = {}
+
+    for drawable in panel.drawables:
+        name = type(drawable).__name__
+        names[name] = names.get(name, 0) + 1
+        name = name if names[name] == 1 else f'{name}.{names[name]}'
+
+        def draw() -> None:
+            for _ in range(frames):
+                drawable.invalidate()
+                drawable.draw_if_changed()
+
+        results[f'ui.{name}'] = Result(1000 * best_time(draw, repeat) / frames, 'ms', higher_is_better=False)
+
+    def full_frame() -> None:
+        for _ in range(frames):
+            panel.invalidate()
+            panel.draw()
+
+    def idle_frame() -> None:
+        for _ in range(frames):
+            panel.draw()
+
+    def running_frame() -> None:
+        for _ in range(frames):
+            machine.run(CHIP8_STEPS_PER_SECOND // FRAMES_PER_SECOND)
+            panel.draw()
+
+    results['ui.panel.full'] = Result(1000 * best_time(full_frame, repeat) / frames, 'ms', higher_is_better=False)
+    results['ui.panel.idle'] = Result(1000 * best_time(idle_frame, repeat) / frames, 'ms', higher_is_better=False)
+    results['ui.panel.running'] = Result(1000 * best_time(running_frame, repeat) / frames, 'ms', higher_is_better=False)
+
+    pygame.quit()
+
+
+def compare(results: Dict[str, Result], baseline: Dict, tolerance: float, output: TextIO = None) -> List[str]:
+    # Prints every benchmark against the baseline, and returns the names of those that got worse beyond the tolerance:
+
+    output = sys.stdout if output is None else output
+    regressions = []
+
+    print(f'{"Benchmark":<36} {"Baseline":>14} {"Current":>14} {"Change":>8}', file=output)
+
+    for name, result in results.items():
+        if name not in baseline['results']:
+            print(f'{name:<36} {"-":>14} {result.value:>14.4g} {"new":>8}', file=output)
+            continue
+
+        previous = baseline['results'][name]['value']
+        change = (result.value - previous) / previous if previous else 0.0
+        worse = -change if result.higher_is_better else change
+        flag = ' REGRESSION' if worse > tolerance else ''
+
+        if flag:
+            regressions.append(name)
+
+        print(f'{name:<36} {previous:>14.4g} {result.value:>14.4g} {100 * change:>+7.1f}%{flag}', file=output)
+
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark decoding, execution, drawing and the UI, and compare against a baseline.')
+    parser.add_argument('--output', help='write the results as JSON to this file ("-" for stdout)')
+    parser.add_argument('--baseline', help='results file of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression (default: 0.1)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark, keeping the fastest (default: 3)')
+    parser.add_argument('--steps', type=int, default=50000, help='instructions per execution benchmark (default: 50000)')
+    parser.add_argument('--no-ui', action='store_true', help='skip the UI benchmarks, which need pygame')
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Result] = {}
+
+    benchmark_decode(results, args.repeat)
+    benchmark_steps(results, args.repeat, args.steps)
+    benchmark_batch(results, args.repeat, args.steps)
+    benchmark_draw(results, args.repeat, args.steps)
+
+    if not args.no_ui:
+        benchmark_ui(results, args.repeat, 100)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': BENCHMARK_SEED,
+        'steps': args.steps,
+        'results': {name: result.to_dict() for name, result in results.items()},
+    }
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if baseline.get('steps') != args.steps:
+            print(f'warning: the baseline ran {baseline.get("steps")} steps per benchmark, not {args.steps}', file=sys.stderr)
+
+        # The JSON report may be on stdout, so the table goes to stderr then, to keep the report parseable:
+        regressions = compare(results, baseline, args.tolerance, sys.stderr if args.output == '-' else sys.stdout)
+
+        if regressions:
+            print(f'{len(regressions)} benchmarks regressed more than {100 * args.tolerance:.0f}%', file=sys.stderr)
+            return 1
+
+    elif args.output != '-':
+        for name, result in results.items():
+            print(f'{name:<36} {result.value:>14.4g} {result.unit}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
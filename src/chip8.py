@@ -1,35 +1,107 @@
 from __future__ import annotations
+from enum import Enum
 import os
 import random
-from typing import List
+import struct
+from typing import Callable, List, Set
 
-from pygame import key
-
-from instruction import Instruction, OperationType, OperandType
+from instruction import Instruction, OperationType, OperandType, decode_instruction
 from tools import *
+from translator import BlockTranslator
+
+
+# Save states are this header followed by the raw machine state buffer:
+SAVE_STATE_MAGIC = b'CHIP8SAV'
+SAVE_STATE_VERSION = 1
+SAVE_STATE_HEADER = struct.Struct('<8sHIQQHH') # Magic, version, buffer size, current step, timers step, keys, previous keys
 
 
 class Chip8:
 
-    def __init__(self, rom: Rom) -> None:
-        self.memory = Memory(4096, rom)
-        self.display = Display(64, 32)
-        self.pc = ProgramCounter(4096)
-        self.index = IndexRegister()
-        self.stack = Stack()
-        self.delay_timer = Timer()
-        self.sound_timer = Timer()
-        self.registers = Registers(16)
+    def __init__(self, rom: Rom, execution_mode: ExecutionMode = None) -> None:
+        self.state = MachineState()
+
+        self.memory = Memory(self.state, rom)
+        self.display = Display(self.state)
+        self.pc = ProgramCounter(self.state)
+        self.index = IndexRegister(self.state)
+        self.stack = Stack(self.state)
+        self.delay_timer = Timer(self.state, CHIP8_BYTE_DELAY_TIMER)
+        self.sound_timer = Timer(self.state, CHIP8_BYTE_SOUND_TIMER)
+        self.registers = Registers(self.state)
+
+        # Raw views of the registers, for the handlers and the translated blocks:
+        self.v = self.state.v
+        self.words = self.state.words
 
         self.current_step = 0
-        self.previous_keys_pressed: List[int] = []
+        self.timers_step = 0
+        self.steps_per_timer_tick = CHIP8_STEPS_PER_SECOND // CHIP8_TIMER_UPDATES_PER_SECOND
+        self.skipped_steps = 0 # Steps fast-forwarded through idle loops instead of executed, part of current_step
+
+        # Where RND draws from: the shared generator of the random module, unless the machine is given its own:
+        self.random = random
+        # Keys are 16-bit masks, with bit N set while key N is held down:
+        self.keys_pressed = 0
+        self.previous_keys_pressed = 0
+
+        self.handlers = {
+            OperationType.UNKNOWN: self.execute_nothing,
+            OperationType.MACHINE_CODE: self.execute_nothing,
+            OperationType.CLEAR_SCREEN: self.execute_clear_screen,
+            OperationType.RETURN_FROM_SUBROUTINE: self.execute_return_from_subroutine,
+            OperationType.ABSOLUTE_JUMP: self.execute_absolute_jump,
+            OperationType.CALL_SUBROUTINE: self.execute_call_subroutine,
+            OperationType.SKIP_IF_EQUALS: self.execute_skip_if_equals,
+            OperationType.SKIP_IF_NOT_EQUALS: self.execute_skip_if_not_equals,
+            OperationType.COPY: self.execute_copy,
+            OperationType.ADD_WITHOUT_CARRY: self.execute_add_without_carry,
+            OperationType.BITWISE_OR: self.execute_bitwise_or,
+            OperationType.BITWISE_AND: self.execute_bitwise_and,
+            OperationType.BITWISE_XOR: self.execute_bitwise_xor,
+            OperationType.ADD_WITH_CARRY: self.execute_add_with_carry,
+            OperationType.SUBTRACTION_DIRECT: self.execute_subtraction_direct,
+            OperationType.SHIFT_RIGHT: self.execute_shift_right,
+            OperationType.SUBTRACTION_REVERSE: self.execute_subtraction_reverse,
+            OperationType.SHIFT_LEFT: self.execute_shift_left,
+            OperationType.ABSOLUTE_JUMP_WITH_OFFSET: self.execute_absolute_jump_with_offset,
+            OperationType.RANDOM_NUMBER: self.execute_random_number,
+            OperationType.DRAW: self.execute_draw,
+            OperationType.SKIP_IF_KEY_PRESSED: self.execute_skip_if_key_pressed,
+            OperationType.SKIP_IF_KEY_NOT_PRESSED: self.execute_skip_if_key_not_pressed,
+            OperationType.GET_DELAY_TIMER: self.execute_get_delay_timer,
+            OperationType.WAIT_FOR_KEY: self.execute_wait_for_key,
+            OperationType.SET_DELAY_TIMER: self.execute_set_delay_timer,
+            OperationType.SET_SOUND_TIMER: self.execute_set_sound_timer,
+            OperationType.LOAD_FONT: self.execute_load_font,
+            OperationType.BCD_CONVERSION: self.execute_bcd_conversion,
+            OperationType.DUMP_REGISTERS_TO_MEMORY: self.execute_dump_registers_to_memory,
+            OperationType.LOAD_REGISTER_FROM_MEMORY: self.execute_load_register_from_memory,
+        }
+
+        self.execution_mode = ExecutionMode.DISPATCH if execution_mode is None else execution_mode
+
+        self.translator: BlockTranslator = None
+        self.breakpoints: Set[int] = set()
+        self.stop_reason: StopReason = None
+
+        if self.execution_mode == ExecutionMode.INTERPRETER:
+            self.execute = self.interpret
+        elif self.execution_mode == ExecutionMode.DISPATCH:
+            self.execute = self.dispatch
+        elif self.execution_mode == ExecutionMode.TRANSLATOR:
+            self.execute = self.dispatch
+            self.translator = BlockTranslator(self)
+        else:
+            raise ValueError(f'unknown execution mode: {self.execution_mode}')
 
         self.reset()
 
 
     def reset(self) -> None:
-        self.memory.configure_font()
-        self.memory.load_rom()
+        # Back to the state right after loading the ROM, so a machine can be reused instead of built again:
+
+        self.memory.reset()
 
         self.display.clear()
         self.pc.set_to(self.memory.bytes_reserved)
@@ -39,14 +111,55 @@ class Chip8:
         self.sound_timer.set_value(0)
         self.registers.clear()
 
+        self.current_step = 0
+        self.timers_step = 0
+        self.skipped_steps = 0
+        self.keys_pressed = 0
+        self.previous_keys_pressed = 0
+        self.stop_reason = None
 
-    def step(self, keys_pressed: List[int] = None) -> None:
-        # Keys:
 
-        if keys_pressed is None:
-            keys_pressed = []
+    def save_state(self) -> bytes:
+        header = SAVE_STATE_HEADER.pack(
+            SAVE_STATE_MAGIC,
+            SAVE_STATE_VERSION,
+            self.state.size,
+            self.current_step,
+            self.timers_step,
+            self.keys_pressed,
+            self.previous_keys_pressed)
+
+        return header + self.state.buffer
+
+
+    def load_state(self, data: bytes) -> None:
+        if len(data) < SAVE_STATE_HEADER.size:
+            raise ValueError('not a save state')
+
+        magic, version, size, current_step, timers_step, keys_pressed, previous_keys_pressed = SAVE_STATE_HEADER.unpack_from(data)
+
+        if magic != SAVE_STATE_MAGIC:
+            raise ValueError('not a save state')
+        elif version != SAVE_STATE_VERSION:
+            raise ValueError(f'unsupported save state version: {version}')
+        elif size != self.state.size or len(data) != SAVE_STATE_HEADER.size + size:
+            raise ValueError('save state size does not match this machine')
+
+        self.state.buffer[:] = memoryview(data)[SAVE_STATE_HEADER.size:]
+
+        self.current_step = current_step
+        self.timers_step = timers_step
+        self.keys_pressed = keys_pressed
+        self.previous_keys_pressed = previous_keys_pressed
+
+        # Everything in memory may have changed, so caches built from it (translated blocks, disassembly) are dropped:
+        self.memory.notify_write(0, self.memory.size)
 
-        key_press_changes = keys_pressed != self.previous_keys_pressed
+
+    def step(self, keys_pressed: int = 0) -> None:
+        # Keys:
+
+        self.keys_pressed = keys_pressed
 
         # Fetch:
 
@@ -55,10 +168,227 @@ class Chip8:
 
         # Decode:
 
-        instruction = Instruction(self.memory[address], self.memory[address+1])
+        instruction = decode_instruction(self.memory[address], self.memory[address+1])
 
         # Execute:
 
+        self.execute(instruction)
+
+        # Keys:
+
+        self.previous_keys_pressed = keys_pressed
+
+        # Timers
+
+        self.current_step += 1
+        self.sync_timers()
+
+
+    def run(self, cycles: int, keys_pressed: int = 0, stop_on_draw: bool = False) -> int:
+        self.keys_pressed = keys_pressed
+        self.stop_reason = StopReason.CYCLES
+
+        words = self.words
+        ram = self.memory.addresses
+        size = self.memory.size
+        execute = self.execute
+        breakpoints = self.breakpoints
+        translator = self.translator
+        control = self.state.control
+        stack_size = len(self.state.stack)
+
+        executed = 0
+
+        while executed < cycles:
+            address = words[CHIP8_WORD_PC]
+
+            if executed > 0 and address in breakpoints:
+                self.stop_reason = StopReason.BREAKPOINT
+                break
+
+            # Whole blocks, when they cannot overshoot the cycle count, skip a breakpoint, hide a draw or overflow the stack
+            # halfway through:
+
+            if translator is not None:
+                block = translator.block_at(address)
+
+                if block.length <= cycles - executed and not (stop_on_draw and block.draws) and not (breakpoints and block.covers_any(breakpoints)) and not (block.calls and control[CHIP8_BYTE_SP] == stack_size):
+                    block.function(self)
+
+                    self.previous_keys_pressed = keys_pressed
+                    self.current_step += block.length
+                    executed += block.length
+
+                    if words[CHIP8_WORD_PC] <= address and not breakpoints:
+                        executed += self.skip_idle_loop(cycles - executed)
+
+                    continue
+
+            # Fetch, decode and execute:
+
+            words[CHIP8_WORD_PC] = (address + 2) % size
+            instruction = decode_instruction(ram[address], ram[(address + 1) % size])
+            execute(instruction)
+
+            self.previous_keys_pressed = keys_pressed
+            self.current_step += 1
+            executed += 1
+
+            # Idle loops can only be entered by jumping backwards, or by a blocked LD Vx, K staying where it is:
+
+            if words[CHIP8_WORD_PC] <= address and not breakpoints:
+                executed += self.skip_idle_loop(cycles - executed)
+
+            if instruction.type == OperationType.WAIT_FOR_KEY and words[CHIP8_WORD_PC] == address:
+                self.stop_reason = StopReason.WAITING_FOR_KEY
+                break
+            elif stop_on_draw and instruction.type in (OperationType.DRAW, OperationType.CLEAR_SCREEN):
+                self.stop_reason = StopReason.DISPLAY_UPDATED
+                break
+
+        self.sync_timers()
+
+        return executed
+
+
+    def skip_idle_loop(self, cycles: int) -> int:
+        # Fast-forwards through a loop that does nothing but wait, leaving the machine exactly as if its steps had been
+        # executed one by one, and returns how many were skipped:
+
+        steps = self.idle_loop_steps(cycles)
+
+        if steps == 0:
+            return 0
+
+        address = self.words[CHIP8_WORD_PC]
+        instruction = decode_instruction(self.memory[address], self.memory[address + 1])
+
+        if instruction.type == OperationType.GET_DELAY_TIMER:
+            # The register keeps the value read by the last iteration, which starts one loop length before the end:
+
+            self.current_step += steps - IDLE_LOOP_DELAY_POLL_LENGTH
+            self.sync_timers()
+            self.v[instruction.operands[0].value] = self.delay_timer.value
+            self.current_step += IDLE_LOOP_DELAY_POLL_LENGTH
+        else:
+            self.current_step += steps
+
+        self.sync_timers()
+        self.previous_keys_pressed = self.keys_pressed
+        self.skipped_steps += steps
+
+        if steps == cycles:
+            self.stop_reason = StopReason.WAITING_FOR_KEY if instruction.type == OperationType.WAIT_FOR_KEY else StopReason.IDLE
+
+        return steps
+
+
+    def idle_loop_steps(self, cycles: int) -> int:
+        # Steps, out of `cycles`, the program will spend in the loop at the program counter without any other effect:
+        # a jump to itself, a LD Vx, K that stays blocked because the keys can't change, or a loop polling the delay
+        # timer (LD Vx, DT; SE/SNE Vx, byte; JP back) until it reaches a value:
+
+        memory = self.memory
+        address = self.words[CHIP8_WORD_PC]
+        instruction = decode_instruction(memory[address], memory[address + 1])
+
+        if instruction.type == OperationType.ABSOLUTE_JUMP and instruction.operands[0].value == address:
+            return cycles
+        elif instruction.type == OperationType.WAIT_FOR_KEY:
+            return 0 if self.previous_keys_pressed & ~self.keys_pressed else cycles
+        elif instruction.type != OperationType.GET_DELAY_TIMER:
+            return 0
+
+        register = instruction.operands[0].value
+        skip = decode_instruction(memory[address + 2], memory[address + 3])
+        jump = decode_instruction(memory[address + 4], memory[address + 5])
+
+        if skip.type not in (OperationType.SKIP_IF_EQUALS, OperationType.SKIP_IF_NOT_EQUALS):
+            return 0
+        elif skip.operands[0].value != register or skip.operands[1].type != OperandType.LITERAL:
+            return 0
+        elif jump.type != OperationType.ABSOLUTE_JUMP or jump.operands[0].value != address:
+            return 0
+
+        # The timer only changes on ticks, so the iterations in between are skipped over rather than tried one by one:
+
+        target = skip.operands[1].value
+        exits_when_equal = skip.type == OperationType.SKIP_IF_EQUALS
+        limit = cycles // IDLE_LOOP_DELAY_POLL_LENGTH
+        steps_per_tick = self.steps_per_timer_tick
+        iterations = 0
+
+        while iterations < limit:
+            step = self.current_step + IDLE_LOOP_DELAY_POLL_LENGTH * iterations
+            value = self.delay_timer_at(step)
+
+            if (value == target) == exits_when_equal:
+                break
+            elif value == 0:
+                iterations = limit
+                break
+
+            next_tick_step = steps_per_tick * ((step + steps_per_tick - 1) // steps_per_tick) + 1
+            iterations = max(iterations + 1, (next_tick_step - self.current_step + IDLE_LOOP_DELAY_POLL_LENGTH - 1) // IDLE_LOOP_DELAY_POLL_LENGTH)
+
+        return IDLE_LOOP_DELAY_POLL_LENGTH * min(iterations, limit)
+
+
+    def delay_timer_at(self, step: int) -> int:
+        # What sync_timers() would make the delay timer at a later step, without changing anything:
+
+        steps_per_tick = self.steps_per_timer_tick
+        ticks = (step + steps_per_tick - 1) // steps_per_tick - (self.timers_step + steps_per_tick - 1) // steps_per_tick
+
+        return max(self.delay_timer.value - ticks, 0)
+
+
+    def sync_timers(self) -> None:
+        # Timers tick after every `steps_per_timer_tick` steps, but are only brought up to date when something reads or
+        # writes them, so batched execution doesn't pay for it on every step:
+
+        if self.timers_step == self.current_step:
+            return
+
+        steps_per_tick = self.steps_per_timer_tick
+        ticks = (self.current_step + steps_per_tick - 1) // steps_per_tick - (self.timers_step + steps_per_tick - 1) // steps_per_tick
+
+        self.delay_timer.decrement_by(ticks)
+        self.sound_timer.decrement_by(ticks)
+        self.timers_step = self.current_step
+
+
+    def step_block(self, keys_pressed: int = 0) -> int:
+        if self.translator is None:
+            self.step(keys_pressed)
+            return 1
+
+        self.keys_pressed = keys_pressed
+
+        # Fetch, decode and execute a whole basic block:
+
+        block = self.translator.block_at(self.pc.value)
+
+        # One instruction at a time when the block would overflow the stack halfway through:
+        if block.calls and len(self.stack) == len(self.state.stack):
+            self.step(keys_pressed)
+            return 1
+
+        block.function(self)
+
+        # Keys:
+
+        self.previous_keys_pressed = keys_pressed
+
+        # Timers
+
+        self.current_step += block.length
+        self.sync_timers()
+
+        return block.length
+
+
+    def interpret(self, instruction: Instruction) -> None:
         if instruction.type == OperationType.MACHINE_CODE:
             pass
 
@@ -75,7 +405,7 @@ class Chip8:
             self.pc.set_to(instruction.operands[0].value)
 
         elif instruction.type == OperationType.CALL_SUBROUTINE:
-            self.stack.push(self.pc.value)
+            self.push_return_address()
             self.pc.set_to(instruction.operands[0].value)
 
         elif instruction.type == OperationType.SKIP_IF_EQUALS:
@@ -220,7 +550,7 @@ class Chip8:
             target_register = self.registers[instruction.operands[0].value]
             literal = instruction.operands[1].value
 
-            random_value = random.randint(0, 0xff)
+            random_value = self.random.randint(0, 0xff)
             result = random_value & literal
             target_register.set_to(random_value & literal)
 
@@ -256,34 +586,36 @@ class Chip8:
         elif instruction.type == OperationType.SKIP_IF_KEY_PRESSED:
             key = self.registers[instruction.operands[0].value].value
 
-            if key in keys_pressed:
+            if (self.keys_pressed >> key) & 0x01:
                 self.pc.increment()
 
         elif instruction.type == OperationType.SKIP_IF_KEY_NOT_PRESSED:
             key = self.registers[instruction.operands[0].value].value
 
-            if key not in keys_pressed:
+            if not (self.keys_pressed >> key) & 0x01:
                 self.pc.increment()
 
         elif instruction.type == OperationType.GET_DELAY_TIMER:
+            self.sync_timers()
             register = self.registers[instruction.operands[0].value]
             register.set_to(self.delay_timer.value)
 
         elif instruction.type == OperationType.WAIT_FOR_KEY:
-            if not key_press_changes:
-                self.pc.set_to(self.pc.value - 2)
+            keys_released = self.previous_keys_pressed & ~self.keys_pressed
+
+            if keys_released:
+                key = (keys_released & -keys_released).bit_length() - 1
+                self.registers[instruction.operands[0].value].set_to(key)
             else:
-                if len(self.previous_keys_pressed) > len(keys_pressed):
-                    key = list(set(self.previous_keys_pressed) - set(keys_pressed))[0]
-                    self.registers[instruction.operands[0].value].set_to(key)
-                else:
-                    self.pc.set_to(self.pc.value - 2)
+                self.pc.set_to((self.pc.value - 2) % self.memory.size)
 
         elif instruction.type == OperationType.SET_DELAY_TIMER:
+            self.sync_timers()
             value = self.registers[instruction.operands[0].value].value
             self.delay_timer.set_value(value)
 
         elif instruction.type == OperationType.SET_SOUND_TIMER:
+            self.sync_timers()
             value = self.registers[instruction.operands[0].value].value
             self.sound_timer.set_value(value)
 
@@ -316,26 +648,304 @@ class Chip8:
             for i in range(last_register + 1):
                 self.registers[i].set_to(self.memory[self.index.value + i])
 
-        # Keys:
 
-        self.previous_keys_pressed = keys_pressed
+    def dispatch(self, instruction: Instruction) -> None:
+        self.handlers[instruction.type](instruction)
 
-        # Timers
 
-        if self.current_step % (CHIP8_STEPS_PER_SECOND // CHIP8_TIMER_UPDATES_PER_SECOND) == 0:
-            self.delay_timer.decrement_if_greater_than_zero()
-            self.sound_timer.decrement_if_greater_than_zero()
+    # Handlers work on the raw views of the machine state (`v`, `words`) instead of the register objects, which are kept
+    # for the interpreter and the UI:
 
-        self.current_step += 1
+    def execute_nothing(self, instruction: Instruction) -> None:
+        pass
+
+
+    def execute_clear_screen(self, instruction: Instruction) -> None:
+        self.display.clear()
+
+
+    def execute_return_from_subroutine(self, instruction: Instruction) -> None:
+        address = self.stack.pop()
+
+        if address is not None:
+            self.words[CHIP8_WORD_PC] = address
+
+
+    def execute_absolute_jump(self, instruction: Instruction) -> None:
+        self.words[CHIP8_WORD_PC] = instruction.operands[0].value
+
+
+    def execute_call_subroutine(self, instruction: Instruction) -> None:
+        self.push_return_address()
+        self.words[CHIP8_WORD_PC] = instruction.operands[0].value
+
+
+    def push_return_address(self) -> None:
+        # A call that overflows the stack doesn't happen, so the program counter goes back to it before the error:
+
+        try:
+            self.stack.push(self.words[CHIP8_WORD_PC])
+        except OverflowError:
+            self.words[CHIP8_WORD_PC] = (self.words[CHIP8_WORD_PC] - 2) % self.memory.size
+            raise
+
+
+    def execute_skip_if_equals(self, instruction: Instruction) -> None:
+        first_operand, second_operand = instruction.operands
+
+        if second_operand.type == OperandType.LITERAL:
+            second_value = second_operand.value
+        elif second_operand.type == OperandType.REGISTER:
+            second_value = self.v[second_operand.value]
+        else:
+            raise ValueError('Illegal instruction')
+
+        if self.v[first_operand.value] == second_value:
+            self.pc.increment()
+
+
+    def execute_skip_if_not_equals(self, instruction: Instruction) -> None:
+        first_operand, second_operand = instruction.operands
+
+        if second_operand.type == OperandType.LITERAL:
+            second_value = second_operand.value
+        elif second_operand.type == OperandType.REGISTER:
+            second_value = self.v[second_operand.value]
+        else:
+            raise ValueError('Illegal instruction')
+
+        if self.v[first_operand.value] != second_value:
+            self.pc.increment()
+
+
+    def execute_copy(self, instruction: Instruction) -> None:
+        target, source = instruction.operands
+
+        if target.type == OperandType.REGISTER:
+            if source.type == OperandType.LITERAL:
+                self.v[target.value] = source.value
+            elif source.type == OperandType.REGISTER:
+                self.v[target.value] = self.v[source.value]
+            else:
+                raise ValueError('Illegal instruction')
+
+        elif target.type == OperandType.INDEX and source.type == OperandType.LITERAL:
+            self.words[CHIP8_WORD_INDEX] = source.value
+
+        else:
+            raise ValueError('Illegal instruction')
+
+
+    def execute_add_without_carry(self, instruction: Instruction) -> None:
+        target, source = instruction.operands
+        v = self.v
+
+        if target.type == OperandType.REGISTER and source.type == OperandType.LITERAL:
+            v[target.value] = (v[target.value] + source.value) & 0x00ff
+        elif target.type == OperandType.INDEX and source.type == OperandType.REGISTER:
+            self.words[CHIP8_WORD_INDEX] = (self.words[CHIP8_WORD_INDEX] + v[source.value]) & 0xffff
+        else:
+            raise ValueError('Illegal instruction')
+
+
+    def execute_bitwise_or(self, instruction: Instruction) -> None:
+        self.v[instruction.operands[0].value] |= self.v[instruction.operands[1].value]
+
+
+    def execute_bitwise_and(self, instruction: Instruction) -> None:
+        self.v[instruction.operands[0].value] &= self.v[instruction.operands[1].value]
+
+
+    def execute_bitwise_xor(self, instruction: Instruction) -> None:
+        self.v[instruction.operands[0].value] ^= self.v[instruction.operands[1].value]
+
+
+    def execute_add_with_carry(self, instruction: Instruction) -> None:
+        v = self.v
+        x, y = instruction.operands[0].value, instruction.operands[1].value
+
+        result = v[x] + v[y]
+        v[x] = result & 0x00ff
+
+        if result > 0x00ff:
+            v[0xf] = 0x01
+
+
+    def execute_subtraction_direct(self, instruction: Instruction) -> None:
+        v = self.v
+        x, y = instruction.operands[0].value, instruction.operands[1].value
+
+        v[0xf] = 0x01 if v[x] >= v[y] else 0x00
+        v[x] = (v[x] - v[y]) & 0x00ff
+
+
+    def execute_shift_right(self, instruction: Instruction) -> None:
+        v = self.v
+        x = instruction.operands[0].value
+
+        v[0xf] = v[x] & 0x01
+        v[x] = (v[x] >> 1) & 0x00ff
+
+
+    def execute_subtraction_reverse(self, instruction: Instruction) -> None:
+        v = self.v
+        x, y = instruction.operands[0].value, instruction.operands[1].value
+
+        v[0xf] = 0x00 if v[x] >= v[y] else 0x01
+        v[x] = (v[y] - v[x]) & 0x00ff
+
+
+    def execute_shift_left(self, instruction: Instruction) -> None:
+        v = self.v
+        x = instruction.operands[0].value
+
+        v[0xf] = v[x] >> 7
+        v[x] = (v[x] << 1) & 0x00ff
+
+
+    def execute_absolute_jump_with_offset(self, instruction: Instruction) -> None:
+        self.words[CHIP8_WORD_PC] = (instruction.operands[0].value + self.v[0x00]) & 0x00ff
+
+
+    def execute_random_number(self, instruction: Instruction) -> None:
+        self.v[instruction.operands[0].value] = self.random.randint(0, 0xff) & instruction.operands[1].value
+
+
+    def execute_draw(self, instruction: Instruction) -> None:
+        vx, vy, literal_n = instruction.operands
+        v = self.v
+
+        x = v[vx.value] % self.display.width
+        y = v[vy.value] % self.display.height
+
+        sprite = self.memory.read(self.words[CHIP8_WORD_INDEX], literal_n.value)
+
+        v[0xf] = 0x00
+
+        if self.display.draw_sprite(x, y, sprite):
+            v[0xf] = 0x01
+
+
+    def execute_skip_if_key_pressed(self, instruction: Instruction) -> None:
+        if (self.keys_pressed >> self.v[instruction.operands[0].value]) & 0x01:
+            self.pc.increment()
+
+
+    def execute_skip_if_key_not_pressed(self, instruction: Instruction) -> None:
+        if not (self.keys_pressed >> self.v[instruction.operands[0].value]) & 0x01:
+            self.pc.increment()
+
+
+    def execute_get_delay_timer(self, instruction: Instruction) -> None:
+        self.sync_timers()
+        self.v[instruction.operands[0].value] = self.delay_timer.value
+
+
+    def execute_wait_for_key(self, instruction: Instruction) -> None:
+        # Waits for a key to be released, and takes the lowest one if several were released at once:
+
+        keys_released = self.previous_keys_pressed & ~self.keys_pressed
+
+        if keys_released:
+            self.v[instruction.operands[0].value] = (keys_released & -keys_released).bit_length() - 1
+        else:
+            self.words[CHIP8_WORD_PC] = (self.words[CHIP8_WORD_PC] - 2) % self.memory.size
+
+
+    def execute_set_delay_timer(self, instruction: Instruction) -> None:
+        self.sync_timers()
+        self.delay_timer.set_value(self.v[instruction.operands[0].value])
+
+
+    def execute_set_sound_timer(self, instruction: Instruction) -> None:
+        self.sync_timers()
+        self.sound_timer.set_value(self.v[instruction.operands[0].value])
+
+
+    def execute_load_font(self, instruction: Instruction) -> None:
+        character = self.v[instruction.operands[0].value] & 0x0f
+        self.words[CHIP8_WORD_INDEX] = self.memory.first_char + 5 * character
+
+
+    def execute_bcd_conversion(self, instruction: Instruction) -> None:
+        number = self.v[instruction.operands[0].value]
+        self.memory.write(self.words[CHIP8_WORD_INDEX], bytes((number // 100, (number // 10) % 10, number % 10)))
+
+
+    def execute_dump_registers_to_memory(self, instruction: Instruction) -> None:
+        last_register = instruction.operands[0].value & 0x0f
+        self.memory.write(self.words[CHIP8_WORD_INDEX], self.v[:last_register + 1].tobytes())
+
+
+    def execute_load_register_from_memory(self, instruction: Instruction) -> None:
+        last_register = instruction.operands[0].value & 0x0f
+        self.v[:last_register + 1] = self.memory.read(self.words[CHIP8_WORD_INDEX], last_register + 1)
+
+
+class ExecutionMode(Enum):
+    INTERPRETER = 0 # Decoded instructions go through the OperationType if/elif chain
+    DISPATCH = 1 # Decoded instructions go straight to their handler
+    TRANSLATOR = 2 # Like DISPATCH, but step_block() runs whole basic blocks compiled into Python functions
+
+
+class StopReason(Enum):
+    CYCLES = 0 # Every requested cycle was executed
+    BREAKPOINT = 1 # The program counter reached an address in Chip8.breakpoints
+    WAITING_FOR_KEY = 2 # LD Vx, K is blocked until a key is released
+    DISPLAY_UPDATED = 3 # A DRW or CLS instruction was executed with stop_on_draw
+    IDLE = 4 # The rest of the cycles were skipped in a loop that only waits for time to pass
+
+
+class MachineState:
+
+    # Formats for the framebuffer rows, which are packed into one unsigned integer each:
+    ROW_FORMATS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+    def __init__(self, memory_size: int = 4096, display_width: int = 64, display_height: int = 32, register_count: int = 16, stack_size: int = CHIP8_STACK_SIZE) -> None:
+        if display_width not in MachineState.ROW_FORMATS:
+            raise ValueError(f'unsupported display width: {display_width}')
+
+        self.memory_size = memory_size
+        self.display_width = display_width
+        self.display_height = display_height
+
+        # The whole machine lives in one buffer, so it can be copied, compared or saved as a single bytes object. RAM
+        # comes first, then the framebuffer (8-aligned), the stack and the CPU block: V0-VF, I and PC, then SP, DT and
+        # ST.
+
+        self.framebuffer_offset = (memory_size + 7) // 8 * 8
+        self.stack_offset = self.framebuffer_offset + display_width // 8 * display_height
+        self.cpu_offset = self.stack_offset + 2 * stack_size
+
+        self.words_offset = (self.cpu_offset + register_count + 1) // 2 * 2
+        self.control_offset = self.words_offset + 4
+
+        self.cpu_size = self.control_offset + 3 - self.cpu_offset
+        self.size = (self.cpu_offset + self.cpu_size + 7) // 8 * 8
+
+        self.buffer = bytearray(self.size)
+        view = memoryview(self.buffer)
+
+        self.ram = view[:memory_size]
+        self.framebuffer = view[self.framebuffer_offset:self.stack_offset].cast(MachineState.ROW_FORMATS[display_width])
+        self.stack = view[self.stack_offset:self.cpu_offset].cast('H')
+        self.v = view[self.cpu_offset:self.cpu_offset + register_count]
+        self.words = view[self.words_offset:self.control_offset].cast('H')
+        self.control = view[self.control_offset:self.control_offset + 3]
+
+
+    def clear(self, start: int, end: int) -> None:
+        self.buffer[start:end] = bytes(end - start)
 
 
 class Memory:
 
-    def __init__(self, size: int, rom: Rom) -> None:
-        self.size = size
+    def __init__(self, state: MachineState, rom: Rom) -> None:
+        self.size = state.memory_size
         self.rom = rom
 
-        self.addresses: List[int] = []
+        self.addresses = state.ram
+        self.write_listeners: List[Callable[[int, int], None]] = []
 
         self.bytes_reserved = 0x200
         self.first_char = 0x50
@@ -345,9 +955,27 @@ class Memory:
         self.configure_font()
         self.load_rom()
 
+        # What reset() brings memory back to:
+        self.initial_contents = bytes(self.addresses)
+
+
+    def reset(self) -> None:
+        # Only the chunks that were modified since loading are rewritten, so write listeners hear about those alone
+        # and the blocks translated from code that is still intact survive:
+
+        initial_contents = self.initial_contents
+
+        for start in range(0, self.size, CHIP8_RESET_CHUNK_SIZE):
+            end = min(start + CHIP8_RESET_CHUNK_SIZE, self.size)
+
+            if self.addresses[start:end] != initial_contents[start:end]:
+                self.addresses[start:end] = initial_contents[start:end]
+                self.notify_write(start, end - start)
+
 
     def clear(self) -> None:
-        self.addresses = [0] * self.size
+        self.addresses[:] = bytes(self.size)
+        self.notify_write(0, self.size)
 
 
     def configure_font(self) -> None:
@@ -370,8 +998,8 @@ class Memory:
             0xf0, 0x80, 0xf0, 0x80, 0x80, # 0x9b: F
         ]
 
-        for i, byte in enumerate(fonts):
-            self.addresses[i + self.first_char] = byte
+        self.addresses[self.first_char:self.first_char + len(fonts)] = bytes(fonts)
+        self.notify_write(self.first_char, len(fonts))
 
 
     def get_addres_of_font(self, font: int) -> int:
@@ -382,8 +1010,10 @@ class Memory:
 
 
     def load_rom(self) -> None:
-        for i, byte in enumerate(self.rom.data):
-            self.addresses[i + self.bytes_reserved] = byte
+        data = memoryview(self.rom.data)[:self.size - self.bytes_reserved]
+
+        self.addresses[self.bytes_reserved:self.bytes_reserved + len(data)] = data
+        self.notify_write(self.bytes_reserved, len(data))
 
 
     def set_address_to(self, address: int, new_value: int) -> None:
@@ -391,51 +1021,125 @@ class Memory:
             raise ValueError('value must fit in 1 byte')
 
         self.addresses[address % self.size] = new_value
+        self.notify_write(address % self.size, 1)
+
+
+    def write(self, address: int, data: bytes) -> None:
+        address %= self.size
+
+        if address + len(data) > self.size:
+            for i, byte in enumerate(data):
+                self.set_address_to(address + i, byte)
+
+            return
+
+        self.addresses[address:address + len(data)] = data
+        self.notify_write(address, len(data))
+
+
+    def add_write_listener(self, listener: Callable[[int, int], None]) -> None:
+        self.write_listeners.append(listener)
+
+
+    def notify_write(self, address: int, length: int) -> None:
+        for listener in self.write_listeners:
+            listener(address, length)
 
 
     def __len__(self):
         return len(self.addresses)
 
 
+    def read(self, address: int, length: int) -> bytes:
+        address %= self.size
+
+        if address + length <= self.size:
+            return self.addresses[address:address + length].tobytes()
+
+        return bytes(self.addresses[(address + i) % self.size] for i in range(length))
+
+
     def __getitem__(self, address) -> int:
         return self.addresses[address % self.size]
 
 
 class Display:
 
-    def __init__(self, width: int, height: int) -> None:
-        self.width = width
-        self.height = height
-        self.pixels: List[List[bool]] = None
+    def __init__(self, state: MachineState) -> None:
+        self.state = state
+        self.width = state.display_width
+        self.height = state.display_height
+
+        # One integer per row, with the leftmost pixel in the most significant of its `width` bits:
+        self.rows = state.framebuffer
 
         self.clear()
 
 
     def clear(self) -> None:
-        self.pixels = [[False for i in range(self.width)] for i in range(self.height)]
+        self.state.clear(self.state.framebuffer_offset, self.state.stack_offset)
 
 
     def get_pixel_at(self, x: int, y: int) -> bool:
-        return self.pixels[y % self.height][x % self.width]
+        return (self.rows[y % self.height] >> (self.width - 1 - x % self.width)) & 0x01 == 0x01
 
 
     def turn_on_pixel_at(self, x: int, y: int) -> None:
-        self.pixels[y % self.height][x % self.width] = True
+        self.rows[y % self.height] |= 1 << (self.width - 1 - x % self.width)
 
 
     def turn_off_pixel_at(self, x: int, y: int) -> None:
-        self.pixels[y % self.height][x % self.width] = False
+        self.rows[y % self.height] &= ~(1 << (self.width - 1 - x % self.width))
+
+
+    def to_bytes(self) -> bytes:
+        return b''.join(row.to_bytes(self.width // 8, 'big') for row in self.rows)
+
+
+    def draw_sprite(self, x: int, y: int, sprite: bytes) -> bool:
+        # XORs 8-pixel-wide sprite rows at (x, y), with x and y already inside the display, and returns whether any
+        # pixel was turned off. Sprites are clipped at the right and bottom edges, except for the first column and row
+        # past them, which wrap around to the left and top edges.
+
+        rows = self.rows
+        shift = self.width - 8 - x
+        wrapped_bit = 1 << (self.width - 1)
+        collision = 0
+
+        for row, byte in enumerate(sprite):
+            if shift >= 0:
+                bits = byte << shift
+            else:
+                bits = byte >> -shift
+
+                if (byte >> (-shift - 1)) & 0x01:
+                    bits |= wrapped_bit
+
+            target = y + row
+
+            if target >= self.height:
+                target -= self.height
+
+            collision |= rows[target] & bits
+            rows[target] ^= bits
+
+            if y + row >= self.height:
+                break
+
+        return collision != 0
 
 
 class Register:
 
-    def __init__(self) -> None:
-        self._value: int = 0
+    def __init__(self, view: memoryview, slot: int) -> None:
+        # Registers don't hold their value, they are views of one slot of the machine state:
+        self.view = view
+        self.slot = slot
 
 
     @property
     def value(self) -> int:
-        return self._value
+        return self.view[self.slot]
 
 
     def set_to(self, new_value: int) -> int:
@@ -448,7 +1152,7 @@ class TwoBytesRegister(Register):
         if new_value > 2**16:
             raise ValueError('value cannot fit in 2 bytes')
 
-        self._value = new_value
+        self.view[self.slot] = new_value
 
 
 class OneByteRegister(Register):
@@ -457,92 +1161,118 @@ class OneByteRegister(Register):
         if new_value > 2**8:
             raise ValueError('value cannot fit in 1 byte')
 
-        self._value = new_value
+        self.view[self.slot] = new_value
 
 
 class ProgramCounter(TwoBytesRegister):
 
-    def __init__(self, memory_size: int) -> None:
-        super().__init__()
-        self.memory_size = memory_size
+    def __init__(self, state: MachineState) -> None:
+        super().__init__(state.words, CHIP8_WORD_PC)
+        self.memory_size = state.memory_size
 
     def increment(self) -> int:
-        self._value += 2
-        self._value %= self.memory_size
+        self.view[self.slot] = (self.view[self.slot] + 2) % self.memory_size
 
 
 class IndexRegister(TwoBytesRegister):
-    pass
+
+    def __init__(self, state: MachineState) -> None:
+        super().__init__(state.words, CHIP8_WORD_INDEX)
 
 
 class Stack:
 
-    def __init__(self) -> None:
-        self._elements: List[int] = None
+    def __init__(self, state: MachineState) -> None:
+        self.state = state
+        self.elements = state.stack
+        self.control = state.control
         self.clear()
 
 
     def push(self, element: int) -> None:
-        self._elements.append(element)
+        depth = self.control[CHIP8_BYTE_SP]
+
+        # The stack has a fixed size in the machine state, so deeper calls are an error rather than lost addresses:
+
+        if depth == len(self.elements):
+            raise OverflowError(f'stack overflow: more than {len(self.elements)} nested calls')
+
+        self.elements[depth] = element
+        self.control[CHIP8_BYTE_SP] = depth + 1
 
 
     def pop(self) -> int:
-        if len(self._elements) == 0:
+        depth = self.control[CHIP8_BYTE_SP]
+
+        if depth == 0:
             return None
 
-        return self._elements.pop()
+        self.control[CHIP8_BYTE_SP] = depth - 1
+        return self.elements[depth - 1]
 
 
     def clear(self) -> None:
-        self._elements = []
+        self.state.clear(self.state.stack_offset, self.state.cpu_offset)
+        self.control[CHIP8_BYTE_SP] = 0
 
 
     def __len__(self):
-        return len(self._elements)
+        return self.control[CHIP8_BYTE_SP]
 
 
     def __getitem__(self, i) -> int:
-        return self._elements[i]
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError('stack index out of range')
+
+        return self.elements[i]
 
 
 class Timer:
 
-    def __init__(self) -> None:
-        self._value = 0
+    def __init__(self, state: MachineState, slot: int) -> None:
+        self.view = state.control
+        self.slot = slot
 
 
     def set_value(self, new_value: int) -> None:
-        self._value = new_value
+        self.view[self.slot] = new_value
 
 
     def decrement_if_greater_than_zero(self) -> None:
-        if self._value > 0:
-            self._value -= 1
+        if self.view[self.slot] > 0:
+            self.view[self.slot] -= 1
+
+
+    def decrement_by(self, ticks: int) -> None:
+        self.view[self.slot] = max(self.view[self.slot] - ticks, 0)
 
 
     @property
     def value(self) -> None:
-        return self._value
+        return self.view[self.slot]
 
 
 class Registers:
 
-    def __init__(self, count: int) -> None:
-        self.count = count
-        self.registers: List[OneByteRegister] = None
-        self.clear()
+    def __init__(self, state: MachineState) -> None:
+        self.values = state.v
+        self.count = len(self.values)
+        self.registers = [OneByteRegister(self.values, i) for i in range(self.count)]
 
 
     def clear(self) -> None:
-        self.registers = [OneByteRegister() for _ in range(self.count)]
+        self.values[:] = bytes(self.count)
 
 
     def turn_on_flag(self) -> None:
-        self.registers[0xf].set_to(0x01)
+        self.values[0xf] = 0x01
 
 
     def turn_off_flag(self) -> None:
-        self.registers[0xf].set_to(0x00)
+        self.values[0xf] = 0x00
 
 
     def __getitem__(self, i) -> OneByteRegister:
@@ -561,7 +1291,8 @@ class Registers:
 class Rom:
 
     def __init__(self, filepath: str) -> None:
-        self.data: List[int] = []
+        # Any bytes-like object, so ROMs can also be views into a memory-mapped archive:
+        self.data: bytes = b''
 
         if filepath is None:
             return
@@ -570,7 +1301,11 @@ class Rom:
             return
         else:
             with open(filepath, 'rb') as rom_file:
-                self.data = []
+                self.data = rom_file.read()
+
 
-                while byte := rom_file.read(1):
-                    self.data.append(byte[0])
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Rom:
+        rom = cls(None)
+        rom.data = data
+        return rom
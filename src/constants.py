@@ -20,14 +20,65 @@ FONT_FAMILY = 'monospace'
 FONT_SIZE = 16
 FONT_WIDTH = 10
 
+TEXT_CACHE_SIZE = 512
+
 MARGIN = 10
 
 FRAMES_PER_SECOND = 60
 
+# Frame pacing:
+
+FRAME_PACER_MAX_FRAMES_BEHIND = 4
+FRAME_PACER_LATE_FRAME_RATIO = 1.5
+FRAME_PACER_MAX_SKIPPED_FRAMES = 3
+FRAME_PACER_REPORT_INTERVAL = 1.0
+
 # CHIP-8:
 
 CHIP8_STEPS_PER_SECOND = 720
 CHIP8_TIMER_UPDATES_PER_SECOND = 60
+CHIP8_MAX_BLOCK_LENGTH = 32
+CHIP8_STACK_SIZE = 16
+CHIP8_RESET_CHUNK_SIZE = 64 # Bytes of memory compared at a time when resetting, so only modified chunks are rewritten
+
+# Slots of the machine state's 16-bit words (I, PC) and control bytes (SP, DT, ST):
+
+CHIP8_WORD_INDEX = 0
+CHIP8_WORD_PC = 1
+CHIP8_BYTE_SP = 0
+CHIP8_BYTE_DELAY_TIMER = 1
+CHIP8_BYTE_SOUND_TIMER = 2
+
+# Rewind:
+
+REWIND_SECONDS = 60
+REWIND_KEYFRAME_INTERVAL = 60
+REWIND_COMPRESSION_LEVEL = 1
+
+# Journal:
+
+JOURNAL_CAPACITY = 32 * 1024 * 1024
+JOURNAL_CHUNK_SIZE = 64 * 1024
+
+# Idle loops:
+
+IDLE_LOOP_DELAY_POLL_LENGTH = 3 # Steps in one iteration of LD Vx, DT; SE/SNE Vx, byte; JP back
+
+# Headless runner:
+
+HEADLESS_CYCLES_PER_CHECK = 10000
+
+# Batch executor:
+
+EXECUTOR_CACHED_MACHINES = 32 # Machines every worker keeps warm, one per ROM and execution mode
+
+# Environments:
+
+ENV_FRAME_SKIP = CHIP8_STEPS_PER_SECOND // FRAMES_PER_SECOND # Instructions per environment step, one 60 Hz frame
+
+# Analysis:
+
+ANALYSIS_CACHED_ROMS = 64
 
 # GameScreen:
 
@@ -0,0 +1,187 @@
+from __future__ import annotations
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+from typing import TYPE_CHECKING, Dict, Iterator, List, TextIO, Tuple
+
+from analysis import Analysis, analyze
+from instruction import Instruction, decode_instruction
+from tools import *
+
+if TYPE_CHECKING:
+    from chip8 import Memory, Rom
+
+
+class Disassembler:
+
+    def __init__(self, memory: Memory) -> None:
+        self.memory = memory
+
+        # Formatted "ADDR  DATA  ASSEMBLY" lines by address, dropped whenever one of their two bytes is written:
+        self.lines: Dict[int, str] = {}
+
+        self.memory.add_write_listener(self.invalidate)
+
+
+    def line_at(self, address: int) -> str:
+        address %= self.memory.size
+        line = self.lines.get(address)
+
+        if line is None:
+            instruction = decode_instruction(self.memory[address], self.memory[address + 1])
+            line = format_instruction(address, instruction)
+            self.lines[address] = line
+
+        return line
+
+
+    def invalidate(self, address: int, length: int) -> None:
+        for written_address in range(address - 1, address + length):
+            self.lines.pop(written_address % self.memory.size, None)
+
+
+    def listing(self, analysis: Analysis = None) -> Iterator[str]:
+        # The listing of the ROM one line at a time: labels, reachable instructions from the same cache as line_at(),
+        # and everything else as data bytes. Instructions whose operand is a labelled address get the label as a
+        # comment:
+
+        memory = self.memory
+        analysis = analyze(memory) if analysis is None else analysis
+        labels = analysis.labels
+        address = analysis.entry
+
+        while address < analysis.rom_end:
+            label = labels.get(address)
+
+            if label is not None:
+                yield f'{label}:'
+
+            if analysis.is_instruction_start(address):
+                line = self.line_at(address)
+                instruction = decode_instruction(memory[address], memory[address + 1])
+                targets = [labels.get(operand.value) for operand in instruction.operands if operand.nibbles == 3]
+
+                if targets and targets[0] is not None:
+                    line = f'{line:<30}; {targets[0]}'
+
+                yield line
+                address += 2
+            else:
+                yield format_data(address, memory[address])
+                address += 1
+
+
+def format_instruction(address: int, instruction: Instruction) -> str:
+    return f'{to_hex(address, 3)}  {instruction.hex}  {instruction.asm}'
+
+
+def format_data(address: int, byte: int) -> str:
+    # Data is mostly sprites, so the bits are drawn next to the byte:
+    pixels = ''.join('#' if bit else '.' for bit in byte_to_bool_list(byte))
+    return f'{to_hex(address, 3)}  {to_hex(byte, 2)}    DB #{to_hex(byte, 2).upper()}  ; {pixels}'
+
+
+def format_data_word(address: int, high: int, low: int) -> str:
+    return f'{to_hex(address, 3)}  {to_hex(high, 2)}{to_hex(low, 2)}  DB #{to_hex(high, 2).upper()}, #{to_hex(low, 2).upper()}'
+
+
+def disassemble(memory: Memory, analysis: Analysis = None) -> Iterator[str]:
+    return Disassembler(memory).listing(analysis)
+
+
+def read_rom(filepath: str) -> Rom:
+    from chip8 import Rom
+
+    rom = Rom(filepath)
+
+    if not rom.data:
+        raise ValueError(f'cannot read ROM "{filepath}"')
+
+    return rom
+
+
+def write_listing(name: str, rom: Rom, output: TextIO) -> int:
+    # Streams the listing of a ROM to `output` and returns its number of lines:
+
+    from chip8 import MachineState, Memory
+
+    output.write(f'; {name}\n')
+    count = 0
+
+    for line in disassemble(Memory(MachineState(), rom)):
+        output.write(line + '\n')
+        count += 1
+
+    return count
+
+
+def disassemble_file(job: Tuple[str, str, str]) -> Tuple[str, int, str, str]:
+    # Runs in the workers: writes the listing to `<output directory>/<name>.asm`, or sends it back as text without an
+    # output directory, so the main process prints the ROMs in order. Returns the name, the number of lines, the
+    # listing and an error message, if any:
+
+    name, filepath, output_directory = job
+
+    try:
+        rom = read_rom(filepath)
+
+        if output_directory is None:
+            output = io.StringIO()
+            return name, write_listing(name, rom, output), output.getvalue(), None
+
+        output_path = os.path.join(output_directory, name + '.asm')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        with open(output_path, 'w') as output_file:
+            return name, write_listing(name, rom, output_file), None, None
+    except (OSError, ValueError) as error:
+        return name, 0, None, str(error)
+
+
+def main(argv: List[str] = None) -> int:
+    from archive import find_roms
+
+    parser = argparse.ArgumentParser(description='Disassemble ROMs, with labels from static analysis, to stdout or to one file per ROM.')
+    parser.add_argument('roms', nargs='+', help='ROM files, or directories to disassemble recursively')
+    parser.add_argument('--output-dir', help='write a <name>.asm listing per ROM in this directory instead of stdout')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, to disassemble many ROMs at once')
+    args = parser.parse_args(argv)
+
+    jobs = ((name, filepath, args.output_dir) for name, filepath in find_roms(args.roms))
+    failures = 0
+
+    # A single process writes straight to stdout, without holding any listing in memory:
+    if args.workers <= 1 and args.output_dir is None:
+        for name, filepath, _ in jobs:
+            try:
+                write_listing(name, read_rom(filepath), sys.stdout)
+            except (OSError, ValueError) as error:
+                failures += 1
+                print(error, file=sys.stderr)
+
+        return 1 if failures else 0
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+    results = pool.imap(disassemble_file, jobs) if pool is not None else map(disassemble_file, jobs)
+
+    try:
+        for name, count, listing, error in results:
+            if error is not None:
+                failures += 1
+                print(error, file=sys.stderr)
+            elif listing is not None:
+                sys.stdout.write(listing)
+            else:
+                print(f'{name}: {count} lines', file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
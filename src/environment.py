@@ -0,0 +1,202 @@
+from __future__ import annotations
+import random
+import sys
+from typing import Callable, Dict, Tuple, Union
+
+import numpy as np
+
+from batch import BatchChip8
+import chip8
+from constants import *
+
+
+# The 8 pixels of every byte value, leftmost in the highest bit, to expand framebuffer bytes with a single np.take():
+PIXELS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+
+# Framebuffer rows are native 64-bit integers, so their leftmost byte is the last one on little-endian hosts:
+ROW_BYTE_ORDER = slice(None, None, -1) if sys.byteorder == 'little' else slice(None)
+
+
+class Chip8Env:
+
+    def __init__(self, rom: chip8.Rom, frame_skip: int = ENV_FRAME_SKIP, max_episode_steps: int = None, reward_function: Callable[[chip8.Chip8], float] = None, termination_function: Callable[[chip8.Chip8], bool] = None, execution_mode: chip8.ExecutionMode = chip8.ExecutionMode.TRANSLATOR) -> None:
+        # An environment in the style of Gym: actions are 16-bit key masks, held for `frame_skip` instructions, and
+        # observations the display as a (height, width) array of 0 and 1. CHIP-8 has no notion of reward or end of
+        # game, so both come from optional functions of the machine:
+
+        # RND draws from a generator of the environment, so seeding one doesn't touch the others or the random module:
+        self.random = random.Random()
+        self.chip8 = chip8.Chip8(rom, execution_mode)
+        self.chip8.random = self.random
+        self.frame_skip = frame_skip
+        self.max_episode_steps = max_episode_steps
+        self.reward_function = reward_function
+        self.termination_function = termination_function
+
+        state = self.chip8.state
+        self.observation_shape = (state.display_height, state.display_width)
+        self.action_count = 1 << 16
+
+        # The observation is rendered into the same array on every step, straight from the bytes of the framebuffer:
+
+        framebuffer = np.frombuffer(state.buffer, dtype=np.uint8, count=state.stack_offset - state.framebuffer_offset, offset=state.framebuffer_offset)
+        self.framebuffer_bytes = framebuffer.reshape(state.display_height, state.display_width // 8)[:, ROW_BYTE_ORDER]
+        self.observation = np.zeros(self.observation_shape, dtype=np.uint8)
+
+        self.episode_steps = 0
+
+
+    def reset(self, seed: int = None) -> Tuple[np.ndarray, Dict]:
+        if seed is not None:
+            self.random.seed(seed)
+
+        self.chip8.reset()
+        self.episode_steps = 0
+        self.render_observation()
+
+        return self.observation, self.info()
+
+
+    def step(self, action: int) -> Tuple[np.ndarray, float, bool, bool, Dict]:
+        # Returns the observation, reward, whether the game ended and whether the episode was cut short. The
+        # observation array is reused by the next step, so it has to be copied to be kept:
+
+        machine = self.chip8
+        executed = 0
+
+        while executed < self.frame_skip:
+            executed += machine.run(self.frame_skip - executed, action)
+
+        self.episode_steps += 1
+        self.render_observation()
+
+        reward = 0.0 if self.reward_function is None else self.reward_function(machine)
+        terminated = False if self.termination_function is None else bool(self.termination_function(machine))
+        truncated = self.max_episode_steps is not None and self.episode_steps >= self.max_episode_steps
+
+        return self.observation, reward, terminated, truncated, self.info()
+
+
+    def render_observation(self) -> None:
+        np.take(PIXELS, self.framebuffer_bytes, axis=0, mode='clip', out=self.observation.reshape(self.observation.shape[0], -1, 8))
+
+
+    def info(self) -> Dict:
+        machine = self.chip8
+
+        return {
+            'cycles': machine.current_step,
+            'episode_steps': self.episode_steps,
+            'sound': machine.sound_timer.value > 0,
+            'idle': machine.stop_reason in (chip8.StopReason.IDLE, chip8.StopReason.WAITING_FOR_KEY),
+        }
+
+
+class VectorChip8Env:
+
+    def __init__(self, rom: chip8.Rom, count: int, frame_skip: int = ENV_FRAME_SKIP, max_episode_steps: int = None, reward_function: Callable[[BatchChip8], np.ndarray] = None, termination_function: Callable[[BatchChip8], np.ndarray] = None, seeds: np.ndarray = None) -> None:
+        # Many environments on the same ROM, stepped together by the NumPy batch engine. Every call takes and returns
+        # arrays with one entry per environment, and environments whose episode is over are reset right away:
+
+        self.machines = BatchChip8(rom, count, seeds)
+        self.count = count
+        self.frame_skip = frame_skip
+        self.max_episode_steps = max_episode_steps
+        self.reward_function = reward_function
+        self.termination_function = termination_function
+
+        machines = self.machines
+        height, width = machines.display_height, machines.display_width
+        self.observation_shape = (height, width)
+        self.action_count = 1 << 16
+
+        # Every array returned is allocated here, and overwritten on every step:
+
+        framebuffer = machines.framebuffer_rows.view(np.uint8).reshape(count, height + 1, 8)
+        self.framebuffer_bytes = framebuffer[:, :height, ROW_BYTE_ORDER]
+
+        self.observations = np.zeros((count, height, width), dtype=np.uint8)
+        self.final_observations = np.zeros((count, height, width), dtype=np.uint8)
+        self.rewards = np.zeros(count, dtype=np.float32)
+        self.terminated = np.zeros(count, dtype=bool)
+        self.truncated = np.zeros(count, dtype=bool)
+        self.finished = np.zeros(count, dtype=bool)
+        self.episode_steps = np.zeros(count, dtype=np.int64)
+        self.final_episode_steps = np.zeros(count, dtype=np.int64)
+
+        # Finished environments are gathered into the front of these, so resetting them doesn't allocate either:
+        self.finished_observations = np.zeros((count, height, width), dtype=np.uint8)
+        self.finished_bytes = np.zeros((count, height, width // 8), dtype=np.uint8)
+
+
+    def reset(self, seeds: np.ndarray = None) -> Tuple[np.ndarray, Dict]:
+        self.machines.reset()
+
+        if seeds is not None:
+            self.machines.seed(seeds)
+
+        self.episode_steps[:] = 0
+        self.render_observations()
+
+        return self.observations, self.info()
+
+
+    def step(self, actions: Union[int, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict]:
+        # Same results as Chip8Env.step(), as arrays. Environments that finished are reset before returning, so their
+        # observation is already the first one of the next episode, and the last one of the finished episode is in
+        # info['final_observation']:
+
+        machines = self.machines
+        machines.run(self.frame_skip, actions)
+
+        self.episode_steps += 1
+        self.render_observations()
+
+        if self.reward_function is not None:
+            self.rewards[:] = self.reward_function(machines)
+
+        # A stack overflow ends the episode of its machine, which the reset below starts again:
+        if self.termination_function is not None:
+            self.terminated[:] = self.termination_function(machines)
+            np.logical_or(self.terminated, machines.halted, out=self.terminated)
+        else:
+            np.copyto(self.terminated, machines.halted)
+
+        if self.max_episode_steps is not None:
+            np.greater_equal(self.episode_steps, self.max_episode_steps, out=self.truncated)
+
+        # Steps where nothing finished, which are most of them, don't allocate anything:
+
+        np.logical_or(self.terminated, self.truncated, out=self.finished)
+
+        if self.finished.any():
+            finished = np.flatnonzero(self.finished)
+            observations = self.finished_observations[:len(finished)]
+            framebuffer_bytes = self.finished_bytes[:len(finished)]
+
+            np.take(self.observations, finished, axis=0, out=observations)
+            self.final_observations[finished] = observations
+            self.final_episode_steps[finished] = self.episode_steps[finished]
+
+            machines.reset(finished)
+            self.episode_steps[finished] = 0
+
+            np.take(self.framebuffer_bytes, finished, axis=0, out=framebuffer_bytes)
+            np.take(PIXELS, framebuffer_bytes, axis=0, out=observations.reshape(len(finished), self.observation_shape[0], -1, 8))
+            self.observations[finished] = observations
+
+        return self.observations, self.rewards, self.terminated, self.truncated, self.info()
+
+
+    def render_observations(self) -> None:
+        np.take(PIXELS, self.framebuffer_bytes, axis=0, mode='clip', out=self.observations.reshape(self.count, self.observation_shape[0], -1, 8))
+
+
+    def info(self) -> Dict:
+        return {
+            'cycles': self.machines.current_step,
+            'episode_steps': self.episode_steps,
+            'final_observation': self.final_observations,
+            'final_episode_steps': self.final_episode_steps,
+            'sound': self.machines.sound_timer > 0,
+        }
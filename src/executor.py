@@ -0,0 +1,272 @@
+from __future__ import annotations
+import argparse
+from array import array
+from collections import OrderedDict
+import json
+import multiprocessing
+import random
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import chip8
+from constants import *
+from headless import HeadlessRunner, KeyScript
+
+
+class Job:
+
+    # Types of the fields, which are checked when reading the jobs, as a wrong one would only fail in a worker:
+    FIELD_TYPES = {
+        'rom': (str,),
+        'cycles': (int,),
+        'seconds': (int, float),
+        'keys': (str,),
+        'seed': (int,),
+        'mode': (str,),
+        'name': (str,),
+    }
+
+
+    def __init__(self, rom: str, cycles: int = None, seconds: float = None, keys: str = '', seed: int = None, mode: str = 'translator', name: str = None) -> None:
+        # Everything is plain data, so jobs are cheap to send to the workers. `keys` is the text of a key script:
+        self.rom = rom
+        self.cycles = cycles
+        self.seconds = seconds
+        self.keys = keys
+        self.seed = seed
+        self.mode = mode
+        self.name = name
+
+
+    @classmethod
+    def from_dict(cls, fields: Dict) -> Job:
+        unknown = set(fields) - set(cls.FIELD_TYPES)
+
+        if unknown:
+            raise ValueError(f'unknown job fields: {", ".join(sorted(unknown))}')
+        elif fields.get('rom') is None:
+            raise ValueError('a job needs a "rom"')
+        elif fields.get('cycles') is None and fields.get('seconds') is None:
+            raise ValueError('a job needs "cycles" or "seconds"')
+
+        # JSON booleans are ints in Python, but never a valid value:
+        for name, value in fields.items():
+            if value is not None and (isinstance(value, bool) or not isinstance(value, cls.FIELD_TYPES[name])):
+                expected = ' or '.join(field_type.__name__ for field_type in cls.FIELD_TYPES[name])
+                raise ValueError(f'job field "{name}" must be {expected}, not {type(value).__name__}')
+
+        return cls(**fields)
+
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'rom': self.rom, 'cycles': self.cycles, 'seconds': self.seconds, 'seed': self.seed, 'mode': self.mode}
+
+
+class JobResult:
+
+    def __init__(self, job: Job, error: str = None) -> None:
+        self.job = job
+        self.error = error
+
+        self.cycles = 0
+        self.instructions = 0
+        self.elapsed = 0.0
+        self.pc = 0
+        self.index = 0
+        self.delay_timer = 0
+        self.sound_timer = 0
+        self.registers = b''
+        self.stack: List[int] = []
+
+        # Raw framebuffer rows, as they are in the machine state buffer, with one bit per pixel of the display width:
+        self.framebuffer = b''
+        self.display_width = 64
+
+
+    @classmethod
+    def from_runner(cls, job: Job, runner: HeadlessRunner) -> JobResult:
+        machine = runner.chip8
+        state = machine.state
+
+        result = cls(job)
+        result.cycles = runner.cycles
+        result.instructions = runner.instructions
+        result.elapsed = runner.elapsed
+        result.pc = machine.pc.value
+        result.index = machine.index.value
+        result.delay_timer = machine.delay_timer.value
+        result.sound_timer = machine.sound_timer.value
+        result.registers = state.v.tobytes()
+        result.stack = [machine.stack[i] for i in range(len(machine.stack))]
+        result.framebuffer = bytes(state.buffer[state.framebuffer_offset:state.stack_offset])
+        result.display_width = state.display_width
+
+        return result
+
+
+    @property
+    def rows(self) -> List[int]:
+        return array(chip8.MachineState.ROW_FORMATS[self.display_width], self.framebuffer).tolist()
+
+
+    def to_dict(self) -> Dict:
+        fields = self.job.to_dict()
+
+        if self.error is not None:
+            fields['error'] = self.error
+            return fields
+
+        # The cycles the job ran, next to the budget it asked for in "cycles":
+        fields.update({
+            'executed_cycles': self.cycles,
+            'instructions': self.instructions,
+            'elapsed': self.elapsed,
+            'pc': self.pc,
+            'index': self.index,
+            'delay_timer': self.delay_timer,
+            'sound_timer': self.sound_timer,
+            'registers': list(self.registers),
+            'stack': self.stack,
+            'display_width': self.display_width,
+            'framebuffer': ''.join(f'{row:0{self.display_width // 4}x}' for row in self.rows),
+        })
+
+        return fields
+
+
+# Machines of this worker process, by ROM path and execution mode, least recently used first:
+_runners: OrderedDict = OrderedDict()
+
+
+def runner_for(job: Job) -> HeadlessRunner:
+    key: Tuple[str, str] = (job.rom, job.mode)
+    runner = _runners.get(key)
+
+    if runner is not None:
+        _runners.move_to_end(key)
+        return runner
+
+    if job.mode.upper() not in chip8.ExecutionMode.__members__:
+        raise ValueError(f'unknown execution mode: {job.mode}')
+
+    rom = chip8.Rom(job.rom)
+
+    if not rom.data:
+        raise ValueError(f'cannot read ROM "{job.rom}"')
+
+    runner = HeadlessRunner(rom, chip8.ExecutionMode[job.mode.upper()])
+    _runners[key] = runner
+
+    if len(_runners) > EXECUTOR_CACHED_MACHINES:
+        _runners.popitem(last=False)
+
+    return runner
+
+
+def run_job(job: Job) -> JobResult:
+    # Runs in a worker: the ROM's machine is reused through reset(), which is much cheaper than building it again and
+    # keeps the blocks it already translated:
+
+    try:
+        runner = runner_for(job)
+        runner.reset(KeyScript.parse(job.keys or ''))
+    except ValueError as error:
+        return JobResult(job, str(error))
+
+    if job.seed is not None:
+        random.seed(job.seed)
+
+    try:
+        runner.run(max_cycles=job.cycles, max_seconds=job.seconds)
+    except OverflowError as error:
+        return JobResult(job, str(error))
+
+    return JobResult.from_runner(job, runner)
+
+
+class Executor:
+
+    def __init__(self, workers: int = None, chunk_size: int = 1) -> None:
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(self.workers)
+
+
+    def run(self, jobs: Iterable[Job]) -> Iterator[JobResult]:
+        # Results come back as soon as their job is done, not in the order of the jobs:
+        return self.pool.imap_unordered(run_job, jobs, self.chunk_size)
+
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+
+    def __enter__(self) -> Executor:
+        return self
+
+
+    def __exit__(self, *exception) -> None:
+        if exception[0] is not None:
+            self.pool.terminate()
+
+        self.close()
+
+
+def read_jobs(lines: Iterable[str]) -> Iterator[Job]:
+    # One JSON object per line, like {"rom": "games/pong.rom", "cycles": 100000, "keys": "0 5\n600 -", "seed": 1}:
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            job = Job.from_dict(json.loads(line))
+        except (ValueError, TypeError) as error:
+            raise ValueError(f'invalid job on line {line_number}: {error}')
+
+        if job.name is None:
+            job.name = str(line_number)
+
+        yield job
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run many ROM jobs on a pool of worker processes, streaming a JSON result per job.')
+    parser.add_argument('jobs', help='file with one JSON job per line ("-" for stdin)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=1, help='jobs sent to a worker at a time, more for many short jobs')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    try:
+        with (sys.stdin if args.jobs == '-' else open(args.jobs, 'r')) as jobs_file:
+            jobs = list(read_jobs(jobs_file))
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start_time = time.perf_counter()
+    instructions = 0
+    failures = 0
+
+    with Executor(args.workers, args.chunk_size) as executor:
+        for result in executor.run(jobs):
+            instructions += result.instructions
+            failures += result.error is not None
+
+            output.write(json.dumps(result.to_dict()) + '\n')
+            output.flush()
+
+    if output is not sys.stdout:
+        output.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f'{len(jobs)} jobs ({failures} failed) on {executor.workers} workers: {instructions} instructions in {elapsed:.3f} s ({instructions / elapsed:.0f} instructions/s)', file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
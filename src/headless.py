@@ -0,0 +1,290 @@
+from __future__ import annotations
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from archive import RomArchive
+import chip8
+from constants import *
+from keypad import keys_to_mask
+from profiler import Profiler
+from tools import *
+
+
+class KeyScript:
+
+    def __init__(self, events: List[Tuple[int, int]] = None) -> None:
+        self.events = sorted(events or [], key=lambda event: event[0])
+
+
+    @classmethod
+    def from_file(cls, filepath: str) -> KeyScript:
+        with open(filepath, 'r') as script_file:
+            return cls.parse(script_file.read())
+
+
+    @classmethod
+    def parse(cls, text: str) -> KeyScript:
+        # Every line is "<cycle> <keys>", where <keys> are the hex digits of the keys held down from that cycle on
+        # ("5", "1c"...) or "-" to release all of them. Everything after a "#" is a comment.
+
+        events = []
+
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            line = line.split('#', 1)[0].strip()
+
+            if not line:
+                continue
+
+            try:
+                cycle, keys = line.split()
+                keys = [] if keys == '-' else [int(key, 16) for key in keys]
+                events.append((int(cycle), keys_to_mask(keys)))
+            except ValueError:
+                raise ValueError(f'invalid key script line {line_number}: "{line}"')
+
+        return cls(events)
+
+
+    def keys_at(self, cycle: int) -> int:
+        keys = 0
+
+        for event_cycle, event_keys in self.events:
+            if event_cycle > cycle:
+                break
+
+            keys = event_keys
+
+        return keys
+
+
+    def next_change_after(self, cycle: int) -> int:
+        for event_cycle, _ in self.events:
+            if event_cycle > cycle:
+                return event_cycle
+
+        return None
+
+
+class HeadlessRunner:
+
+    def __init__(self, rom: chip8.Rom, execution_mode: chip8.ExecutionMode = None, key_script: KeyScript = None, profile: bool = False) -> None:
+        self.chip8 = chip8.Chip8(rom, execution_mode)
+        self.key_script = KeyScript() if key_script is None else key_script
+        self.profiler = Profiler(self.chip8) if profile else None
+
+        # Cycles are the steps the machine went through, instructions those it actually executed, as idle loops are
+        # fast-forwarded:
+        self.cycles = 0
+        self.instructions = 0
+        self.elapsed = 0.0
+
+
+    def reset(self, key_script: KeyScript = None) -> None:
+        # Ready for another run of the same ROM, keeping the machine and its translated blocks:
+
+        self.chip8.reset()
+        self.key_script = KeyScript() if key_script is None else key_script
+
+        if self.profiler is not None:
+            self.profiler.reset()
+
+        self.cycles = 0
+        self.instructions = 0
+        self.elapsed = 0.0
+
+
+    def run(self, max_cycles: int = None, max_seconds: float = None) -> None:
+        if max_cycles is None and max_seconds is None:
+            raise ValueError('a cycle count or a time budget is needed')
+
+        start_time = time.perf_counter()
+        deadline = None if max_seconds is None else start_time + max_seconds
+
+        machine = self.chip8
+        run = machine.run if self.profiler is None else self.profiler.run
+        start_cycles = self.cycles
+        start_step = machine.current_step
+        start_skipped_steps = machine.skipped_steps
+
+        keys = self.key_script.keys_at(self.cycles)
+        next_change = self.key_script.next_change_after(self.cycles)
+
+        # Stack overflows stop the run with an OverflowError, after counting what ran until then:
+
+        try:
+            while max_cycles is None or self.cycles < max_cycles:
+                if next_change is not None and self.cycles >= next_change:
+                    keys = self.key_script.keys_at(self.cycles)
+                    next_change = self.key_script.next_change_after(self.cycles)
+
+                # Run up to the budget, the next key change or the next deadline check, whichever comes first:
+
+                limits = [max_cycles, next_change, self.cycles + HEADLESS_CYCLES_PER_CHECK if deadline is not None else None]
+                limit = min(limit for limit in limits if limit is not None)
+
+                self.cycles += run(limit - self.cycles, keys)
+
+                # With no key change left, a machine stuck in an idle loop only lets time pass, so the rest of the cycle
+                # budget is skipped at once, and a time budget isn't spent at all:
+
+                if next_change is None and machine.stop_reason in (chip8.StopReason.IDLE, chip8.StopReason.WAITING_FOR_KEY) and self.idle_forever():
+                    if max_cycles is not None:
+                        self.cycles += run(max_cycles - self.cycles, keys)
+
+                    break
+
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+        except OverflowError:
+            self.cycles = start_cycles + machine.current_step - start_step
+            raise
+        finally:
+            self.instructions += self.cycles - start_cycles - (machine.skipped_steps - start_skipped_steps)
+            self.elapsed += time.perf_counter() - start_time
+
+
+    def idle_forever(self) -> bool:
+        # Whether the loop at the program counter never ends: a jump to itself, a LD Vx, K with the same keys, or a delay
+        # timer poll still looping after the timer runs out, which takes at most 255 ticks:
+
+        machine = self.chip8
+        horizon = IDLE_LOOP_DELAY_POLL_LENGTH * (0x100 * machine.steps_per_timer_tick + 1)
+
+        return machine.idle_loop_steps(horizon) == horizon
+
+
+    @property
+    def steps_per_second(self) -> float:
+        return self.instructions / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def format_display(display: chip8.Display) -> str:
+    lines = []
+
+    for row in display.rows:
+        lines.append(format(row, f'0{display.width}b').replace('0', '.').replace('1', '#'))
+
+    return '\n'.join(lines)
+
+
+def format_registers(machine: chip8.Chip8) -> str:
+    registers = ' '.join(f'V{to_hex(i, 1)}={to_hex(register.value, 2)}' for i, register in enumerate(machine.registers))
+    stack = ' '.join(to_hex(machine.stack[i], 3) for i in range(len(machine.stack)))
+
+    return '\n'.join([
+        f'PC={to_hex(machine.pc.value, 3)} I={to_hex(machine.index.value, 4)} DT={to_hex(machine.delay_timer.value, 2)} ST={to_hex(machine.sound_timer.value, 2)}',
+        registers,
+        f'Stack: {stack}',
+    ])
+
+
+def dump_state(runner: HeadlessRunner) -> Dict:
+    machine = runner.chip8
+    display = machine.display
+
+    return {
+        'cycles': runner.cycles,
+        'instructions': runner.instructions,
+        'elapsed': runner.elapsed,
+        'steps_per_second': runner.steps_per_second,
+        'pc': machine.pc.value,
+        'index': machine.index.value,
+        'delay_timer': machine.delay_timer.value,
+        'sound_timer': machine.sound_timer.value,
+        'registers': [register.value for register in machine.registers],
+        'stack': [machine.stack[i] for i in range(len(machine.stack))],
+        'display': format_display(display).splitlines(),
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run a CHIP-8 ROM without a window, as fast as possible.')
+    parser.add_argument('rom', help='ROM file to run, or ROM name with --archive')
+    parser.add_argument('--archive', help='ROM archive to take the ROM from')
+    parser.add_argument('--cycles', type=int, help='number of instructions to execute')
+    parser.add_argument('--seconds', type=float, help='wall-clock time budget')
+    parser.add_argument('--keys', help='key script file, with "<cycle> <keys>" lines')
+    parser.add_argument('--mode', choices=[mode.name.lower() for mode in chip8.ExecutionMode], default='translator')
+    parser.add_argument('--seed', type=int, help='seed for the RND instruction')
+    parser.add_argument('--dump', help='write the final state as JSON to this file ("-" for stdout)')
+    parser.add_argument('--load-state', help='start from a save state file instead of a reset machine')
+    parser.add_argument('--save-state', help='write a save state file at the end')
+    parser.add_argument('--profile', action='store_true', help='count instructions per operation and address, and print a report')
+    parser.add_argument('--profile-json', help='write the profile as JSON to this file')
+    args = parser.parse_args(argv)
+
+    if args.cycles is None and args.seconds is None:
+        parser.error('one of --cycles or --seconds is required')
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if args.archive:
+        try:
+            with RomArchive(args.archive) as archive:
+                if args.rom not in archive:
+                    parser.error(f'no ROM named "{args.rom}" in "{args.archive}"')
+
+                rom = archive.rom(args.rom)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+    else:
+        rom = chip8.Rom(args.rom)
+
+    if not rom.data:
+        parser.error(f'cannot read ROM "{args.rom}"')
+
+    key_script = KeyScript.from_file(args.keys) if args.keys else None
+    runner = HeadlessRunner(rom, chip8.ExecutionMode[args.mode.upper()], key_script, args.profile or args.profile_json is not None)
+
+    if args.load_state:
+        try:
+            with open(args.load_state, 'rb') as state_file:
+                runner.chip8.load_state(state_file.read())
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+
+    error = None
+
+    try:
+        runner.run(max_cycles=args.cycles, max_seconds=args.seconds)
+    except OverflowError as overflow:
+        error = str(overflow)
+
+    if args.save_state:
+        with open(args.save_state, 'wb') as state_file:
+            state_file.write(runner.chip8.save_state())
+
+    if args.dump == '-':
+        json.dump(dump_state(runner), sys.stdout, indent=2)
+        print()
+    else:
+        if args.dump:
+            with open(args.dump, 'w') as dump_file:
+                json.dump(dump_state(runner), dump_file, indent=2)
+
+        print(format_display(runner.chip8.display))
+        print(format_registers(runner.chip8))
+        print(f'{runner.cycles} cycles, {runner.instructions} instructions executed in {runner.elapsed:.3f} s ({runner.steps_per_second:.0f} instructions/s)')
+
+    if args.profile:
+        print()
+        print(runner.profiler.report())
+
+    if args.profile_json:
+        with open(args.profile_json, 'w') as profile_file:
+            profile_file.write(runner.profiler.to_json())
+
+    if error is not None:
+        print(f'error: {error}', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,8 @@ class Hexable:
 class Instruction(Hexable):
 
     def __init__(self, msb: int, lsb: int) -> None:
+        self.opcode = (msb << 8) | lsb
+
         self.k = msb >> 4
         self.x = msb & 0x0f
         self.y = lsb >> 4
@@ -22,7 +24,7 @@ class Instruction(Hexable):
         self.nnn = (self.x << 8) | lsb
 
         self.type: OperationType = None
-        self.operands: List[Operand] = []
+        self.operands: Tuple[Operand, ...] = ()
 
         self.decode()
 
@@ -157,6 +159,9 @@ class Instruction(Hexable):
                 self.type = OperationType.LOAD_REGISTER_FROM_MEMORY
                 self.operands.append(Operand(OperandType.REGISTER, self.x, 1))
 
+        # Decoded instructions are shared through the decode table, so they must not change afterwards:
+        self.operands = tuple(self.operands)
+
 
     @property
     def hex(self) -> str:
@@ -256,6 +261,20 @@ class Instruction(Hexable):
         return f'Instruction(0x{self.hex}, "{self.asm}")'
 
 
+_DECODE_TABLE: List[Instruction] = [None] * 0x10000
+
+
+def decode_instruction(msb: int, lsb: int) -> Instruction:
+    opcode = (msb << 8) | lsb
+    instruction = _DECODE_TABLE[opcode]
+
+    if instruction is None:
+        instruction = Instruction(msb, lsb)
+        _DECODE_TABLE[opcode] = instruction
+
+    return instruction
+
+
 class OperationType(Enum):
     UNKNOWN = 0
     ABSOLUTE_JUMP = 1 # SYS addr
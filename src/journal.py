@@ -0,0 +1,270 @@
+from __future__ import annotations
+from array import array
+from collections import deque
+import struct
+from typing import Deque, List, Tuple
+
+from chip8 import Chip8, StopReason
+from instruction import Instruction, OperandType, OperationType, decode_instruction
+from tools import *
+
+
+# Every entry is this header, PC, SP, DT and ST as they were before the instruction (every step can change them), and
+# then the other regions of the machine state buffer the instruction overwrote, registers included, each one prefixed
+# by its offset and length:
+JOURNAL_ENTRY_HEADER = struct.Struct('<IIHHBB') # Steps taken, steps since the last timer sync, keys, previous keys, skipped idle steps or not, region count
+JOURNAL_REGION_HEADER = struct.Struct('<HH') # Offset, length
+
+# Instructions that write the register of their first operand, and those that also write VF:
+REGISTER_WRITING_INSTRUCTIONS = {
+    OperationType.BITWISE_AND,
+    OperationType.BITWISE_OR,
+    OperationType.BITWISE_XOR,
+    OperationType.GET_DELAY_TIMER,
+    OperationType.RANDOM_NUMBER,
+    OperationType.WAIT_FOR_KEY,
+}
+FLAG_WRITING_INSTRUCTIONS = {
+    OperationType.ADD_WITH_CARRY,
+    OperationType.SHIFT_LEFT,
+    OperationType.SHIFT_RIGHT,
+    OperationType.SUBTRACTION_DIRECT,
+    OperationType.SUBTRACTION_REVERSE,
+}
+
+
+class Journal:
+
+    def __init__(self, chip8: Chip8, capacity: int = JOURNAL_CAPACITY, chunk_size: int = JOURNAL_CHUNK_SIZE) -> None:
+        self.chip8 = chip8
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+
+        # The log is a queue of byte chunks, with the start of every entry in the parallel arrays of `starts`, so the
+        # oldest history can be dropped a whole chunk at a time:
+        self.chunks: Deque[bytearray] = deque()
+        self.starts: Deque[array] = deque()
+        self.entries = 0
+
+        state = chip8.state
+        self.control_start = state.words_offset + 2 * CHIP8_WORD_PC
+        self.control_end = state.control_offset + len(state.control)
+
+
+    def step(self, keys_pressed: int = 0) -> None:
+        chip8 = self.chip8
+        memory = chip8.memory
+
+        address = chip8.words[CHIP8_WORD_PC]
+        self.record(decode_instruction(memory[address], memory[address + 1]))
+
+        # A call that overflows the stack leaves the machine as it was, so its entry has nothing to undo:
+
+        try:
+            chip8.step(keys_pressed)
+        except OverflowError:
+            self.discard()
+            raise
+
+
+    def run(self, cycles: int, keys_pressed: int = 0) -> int:
+        chip8 = self.chip8
+        chip8.stop_reason = StopReason.CYCLES
+
+        words = chip8.words
+        memory = chip8.memory
+        executed = 0
+
+        while executed < cycles:
+            address = words[CHIP8_WORD_PC]
+            self.step(keys_pressed)
+            executed += 1
+
+            # Idle loops are skipped like in Chip8.run(), and recorded as a single entry that undoes all their steps:
+
+            if words[CHIP8_WORD_PC] <= address and not chip8.breakpoints:
+                steps = chip8.idle_loop_steps(cycles - executed)
+
+                if steps > 0:
+                    address = words[CHIP8_WORD_PC]
+                    self.record(decode_instruction(memory[address], memory[address + 1]), steps, skipped=True)
+                    executed += chip8.skip_idle_loop(cycles - executed)
+
+        return executed
+
+
+    def record(self, instruction: Instruction, steps: int = 1, skipped: bool = False) -> None:
+        chip8 = self.chip8
+        buffer = chip8.state.buffer
+
+        if not self.chunks or len(self.chunks[-1]) >= self.chunk_size:
+            self.add_chunk()
+
+        chunk = self.chunks[-1]
+        self.starts[-1].append(len(chunk))
+
+        regions = self.regions_written_by(instruction)
+
+        chunk += JOURNAL_ENTRY_HEADER.pack(
+            steps,
+            chip8.current_step - chip8.timers_step,
+            chip8.keys_pressed,
+            chip8.previous_keys_pressed,
+            skipped,
+            len(regions))
+        chunk += buffer[self.control_start:self.control_end]
+
+        for offset, length in regions:
+            chunk += JOURNAL_REGION_HEADER.pack(offset, length)
+            chunk += buffer[offset:offset + length]
+
+        self.entries += 1
+
+
+    def undo(self) -> bool:
+        # Restores the state from before the last recorded instruction or skipped idle loop, and returns whether there was one:
+
+        if self.entries == 0:
+            return False
+
+        chip8 = self.chip8
+        state = chip8.state
+        buffer = state.buffer
+
+        chunk = self.chunks[-1]
+        start = self.starts[-1][-1]
+
+        steps, steps_since_sync, keys_pressed, previous_keys_pressed, skipped, region_count = JOURNAL_ENTRY_HEADER.unpack_from(chunk, start)
+        position = start + JOURNAL_ENTRY_HEADER.size
+
+        control_size = self.control_end - self.control_start
+        buffer[self.control_start:self.control_end] = chunk[position:position + control_size]
+        position += control_size
+
+        for _ in range(region_count):
+            offset, length = JOURNAL_REGION_HEADER.unpack_from(chunk, position)
+            position += JOURNAL_REGION_HEADER.size
+
+            buffer[offset:offset + length] = chunk[position:position + length]
+            position += length
+
+            if offset < state.memory_size:
+                chip8.memory.notify_write(offset, length)
+
+        chip8.current_step -= steps
+        chip8.timers_step = chip8.current_step - steps_since_sync
+        chip8.keys_pressed = keys_pressed
+        chip8.previous_keys_pressed = previous_keys_pressed
+
+        if skipped:
+            chip8.skipped_steps -= steps
+
+        self.discard()
+
+        return True
+
+
+    def discard(self) -> None:
+        # Forgets the last entry without restoring anything:
+
+        del self.chunks[-1][self.starts[-1].pop():]
+        self.entries -= 1
+
+        if not self.starts[-1]:
+            self.chunks.pop()
+            self.starts.pop()
+
+
+    def regions_written_by(self, instruction: Instruction) -> List[Tuple[int, int]]:
+        # Regions of the state buffer, other than PC, SP and the timers, that the instruction is about to overwrite:
+
+        state = self.chip8.state
+        v = self.chip8.v
+        operation = instruction.type
+
+        if operation in REGISTER_WRITING_INSTRUCTIONS:
+            return [(state.cpu_offset + instruction.operands[0].value, 1)]
+
+        elif operation in FLAG_WRITING_INSTRUCTIONS:
+            return [(state.cpu_offset + instruction.operands[0].value, 1), (state.cpu_offset + 0xf, 1)]
+
+        elif operation in (OperationType.COPY, OperationType.ADD_WITHOUT_CARRY):
+            if instruction.operands[0].type == OperandType.INDEX:
+                return [(state.words_offset + 2 * CHIP8_WORD_INDEX, 2)]
+
+            return [(state.cpu_offset + instruction.operands[0].value, 1)]
+
+        elif operation == OperationType.LOAD_FONT:
+            return [(state.words_offset + 2 * CHIP8_WORD_INDEX, 2)]
+
+        elif operation == OperationType.LOAD_REGISTER_FROM_MEMORY:
+            return [(state.cpu_offset, (instruction.operands[0].value & 0x0f) + 1)]
+
+        elif operation == OperationType.CALL_SUBROUTINE:
+            depth = state.control[CHIP8_BYTE_SP]
+
+            if depth < len(state.stack):
+                return [(state.stack_offset + 2 * depth, 2)]
+
+            return [(state.stack_offset, 2 * len(state.stack))]
+
+        elif operation == OperationType.BCD_CONVERSION:
+            return self.memory_regions(self.chip8.words[CHIP8_WORD_INDEX], 3)
+
+        elif operation == OperationType.DUMP_REGISTERS_TO_MEMORY:
+            return self.memory_regions(self.chip8.words[CHIP8_WORD_INDEX], (instruction.operands[0].value & 0x0f) + 1)
+
+        elif operation == OperationType.CLEAR_SCREEN:
+            return [(state.framebuffer_offset, state.stack_offset - state.framebuffer_offset)]
+
+        elif operation == OperationType.DRAW:
+            # Same rows as Display.draw_sprite(): from y down to the bottom edge, plus the top one when it wraps around:
+
+            height = state.display_height
+            row_size = state.display_width // 8
+
+            y = v[instruction.operands[1].value] % height
+            rows = instruction.operands[2].value
+
+            regions = [(state.framebuffer_offset + row_size * y, row_size * min(rows, height - y)), (state.cpu_offset + 0xf, 1)]
+
+            if y + rows > height:
+                regions.append((state.framebuffer_offset, row_size))
+
+            return regions
+
+        return []
+
+
+    def memory_regions(self, address: int, length: int) -> List[Tuple[int, int]]:
+        size = self.chip8.state.memory_size
+        address %= size
+
+        if address + length <= size:
+            return [(address, length)]
+
+        return [(address, size - address), (0, address + length - size)]
+
+
+    def add_chunk(self) -> None:
+        self.chunks.append(bytearray())
+        self.starts.append(array('I'))
+
+        while len(self.chunks) > 1 and len(self.chunks) * self.chunk_size > self.capacity:
+            self.entries -= len(self.starts.popleft())
+            self.chunks.popleft()
+
+
+    def clear(self) -> None:
+        self.chunks.clear()
+        self.starts.clear()
+        self.entries = 0
+
+
+    @property
+    def memory_used(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks) + sum(len(starts) * starts.itemsize for starts in self.starts)
+
+
+    def __len__(self) -> int:
+        return self.entries
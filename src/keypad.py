@@ -0,0 +1,29 @@
+from typing import Iterable
+
+
+class Keypad:
+
+    def __init__(self) -> None:
+        # Bit N is set while key N is held down:
+        self.mask = 0
+
+
+    def press(self, key: int) -> None:
+        self.mask |= 1 << key
+
+
+    def release(self, key: int) -> None:
+        self.mask &= ~(1 << key)
+
+
+    def clear(self) -> None:
+        self.mask = 0
+
+
+def keys_to_mask(keys: Iterable[int]) -> int:
+    mask = 0
+
+    for key in keys:
+        mask |= 1 << key
+
+    return mask
@@ -1,3 +1,4 @@
+import argparse
 from enum import Enum
 import os
 from typing import List
@@ -7,12 +8,16 @@ import pygame
 
 import chip8
 from constants import *
+from journal import Journal
+from keypad import Keypad
+from pacing import FramePacer
+from rewind import RewindBuffer
 import ui
 
 
 class Engine:
 
-    def __init__(self, rom: chip8.Rom) -> None:
+    def __init__(self, rom: chip8.Rom, steps_per_second: int = CHIP8_STEPS_PER_SECOND, rewind_seconds: int = REWIND_SECONDS, journal: bool = True) -> None:
         pygame.init()
         pygame.font.init()
 
@@ -20,77 +25,167 @@ class Engine:
         pygame.display.set_caption('CHIP-8 Interpreter [PAUSED]')
 
         self.last_event: Key = None
-        self.keys_pressed: List[Key] = []
+        self.keypad = Keypad()
+        self.rewinding = False
 
         self.chip8 = chip8.Chip8(rom)
+        self.chip8.steps_per_timer_tick = max(steps_per_second // CHIP8_TIMER_UPDATES_PER_SECOND, 1)
         self.panel = ui.Panel(self.screen, self.chip8)
+        self.pacer = FramePacer(steps_per_second)
+        self.rewind_buffer = RewindBuffer(rewind_seconds * FRAMES_PER_SECOND)
+
+        # Every executed instruction goes through the journal when it's enabled, so the debugger can step back:
+        self.journal = Journal(self.chip8) if journal else None
+
+        self.screen.fill(BACKGROUND_COLOR)
+        pygame.display.update()
 
 
     def run(self) -> None:
         clock = pygame.time.Clock()
         self.running = True
-
-        steps_per_frame = CHIP8_STEPS_PER_SECOND // FRAMES_PER_SECOND
-
-        step = 0
         self.chip8_paused = True
 
+        drawn = False
+
         while self.running:
-            self.manage_inputs()
-            self.update()
-            
-            if step % steps_per_frame == 0:
+            if drawn and self.idle():
+                # Nothing can change before the next input, so instead of spinning through identical frames the loop
+                # sleeps until there is an event, and doesn't owe the CHIP-8 the time it slept:
+
+                self.manage_inputs([pygame.event.wait()] + pygame.event.get())
+                self.pacer.reset()
+            else:
+                self.manage_inputs(pygame.event.get())
+
+            self.update(self.pacer.steps_for_frame())
+
+            drawn = self.pacer.should_draw()
+
+            if drawn:
                 self.draw()
-                self.play_sounds()
 
-            clock.tick(CHIP8_STEPS_PER_SECOND)
-            step += 1
+            self.play_sounds()
+            clock.tick(FRAMES_PER_SECOND)
+
+
+    def idle(self) -> bool:
+        # Paused, or spinning in a loop that only waits for a key or forever, with both timers already run down:
+
+        if self.rewinding or self.chip8.delay_timer.value > 0 or self.chip8.sound_timer.value > 0:
+            return False
+
+        return self.chip8_paused or self.chip8.stop_reason in (chip8.StopReason.IDLE, chip8.StopReason.WAITING_FOR_KEY)
 
 
-    def manage_inputs(self) -> None:
+    def manage_inputs(self, events: List[pygame.event.Event]) -> None:
         self.last_event: Key = None
 
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     self.running = False
                 elif event.key in CONTROLS_MAP:
-                    self.last_event = CONTROLS_MAP[event.key]
-
-        self.keys_pressed = []
-
-        for key in CONTROLS_MAP.keys():
-            if pygame.key.get_pressed()[key] == 1:
-                if CONTROLS_MAP[key].value >= 0x00 and CONTROLS_MAP[key].value <= 0x0f:
-                    self.keys_pressed.append(CONTROLS_MAP[key])
-
-
-    def update(self) -> None:
+                    key = CONTROLS_MAP[event.key]
+
+                    if key.value <= 0x0f:
+                        self.keypad.press(key.value)
+                    elif key == Key.KEY_REWIND:
+                        self.rewinding = True
+                    else:
+                        self.last_event = key
+            elif event.type == pygame.KEYUP:
+                if event.key in CONTROLS_MAP and CONTROLS_MAP[event.key].value <= 0x0f:
+                    self.keypad.release(CONTROLS_MAP[event.key].value)
+                elif event.key in CONTROLS_MAP and CONTROLS_MAP[event.key] == Key.KEY_REWIND:
+                    self.rewinding = False
+                    pygame.display.set_caption(f'CHIP-8 Interpreter [{"PAUSED" if self.chip8_paused else "RUNNING"}]')
+            elif event.type == pygame.WINDOWFOCUSLOST:
+                self.keypad.clear()
+                self.rewinding = False
+
+
+    def update(self, steps: int) -> None:
         if self.last_event is not None:
             if self.last_event == Key.KEY_STEP and self.chip8_paused:
-                self.chip8.step()
+                if self.journal is not None:
+                    self.journal.step()
+                else:
+                    self.chip8.step()
+            elif self.last_event == Key.KEY_STEP_BACK and self.chip8_paused:
+                if self.journal is not None:
+                    self.journal.undo()
             elif self.last_event == Key.KEY_RESET:
                 self.chip8_paused = True
                 self.chip8.reset()
+                self.clear_journal()
+
+                # Frames from before the reset must not be rewound onto the reset machine:
+                self.rewind_buffer.clear()
+                self.rewinding = False
+
                 pygame.display.set_caption('CHIP-8 Interpreter [PAUSED]')
             elif self.last_event == Key.KEY_PLAY_PAUSE:
                 self.chip8_paused = not self.chip8_paused
+                self.pacer.reset()
 
                 if self.chip8_paused:
                     pygame.display.set_caption('CHIP-8 Interpreter [PAUSED]')
                 else:
                     pygame.display.set_caption('CHIP-8 Interpreter [RUNNING]')
 
-        if not self.chip8_paused:
-            self.chip8.step([k.value for k in self.keys_pressed])
+        if self.rewinding:
+            # Goes back one recorded frame per frame, for as long as the key is held and there is history left:
+
+            snapshot = self.rewind_buffer.rewind()
+
+            if snapshot is not None:
+                self.chip8.load_state(snapshot)
+                self.clear_journal()
+
+            seconds = len(self.rewind_buffer) / FRAMES_PER_SECOND
+            pygame.display.set_caption(f'CHIP-8 Interpreter [REWINDING] {seconds:.1f} s left')
+
+        elif not self.chip8_paused:
+            self.rewind_buffer.record(self.chip8.save_state())
+
+            run = self.chip8.run if self.journal is None else self.journal.run
+            executed = 0
+
+            # run() can return before the frame's steps are done, but they still have to elapse for the timers:
+
+            # A stack overflow pauses the machine, and the journal can step back from the failing call:
+
+            try:
+                while executed < steps:
+                    executed += run(steps - executed, self.keypad.mask)
+            except OverflowError as error:
+                self.chip8_paused = True
+                pygame.display.set_caption(f'CHIP-8 Interpreter [PAUSED] {error}')
+                return
+
+            if self.pacer.record(executed):
+                achieved = self.pacer.achieved_steps_per_second
+                target = self.pacer.steps_per_second
+                seconds = len(self.rewind_buffer) / FRAMES_PER_SECOND
+                kilobytes = self.rewind_buffer.memory_used / 1024
+                pygame.display.set_caption(f'CHIP-8 Interpreter [RUNNING] {achieved:.0f}/{target} instructions/s, rewind {seconds:.0f} s in {kilobytes:.0f} KB')
+
+
+    def clear_journal(self) -> None:
+        # Resets and rewinds replace the whole machine state, so instructions from before them can't be undone:
+
+        if self.journal is not None:
+            self.journal.clear()
 
 
     def draw(self) -> None:
-        self.screen.fill(BACKGROUND_COLOR)
-        self.panel.draw()
-        pygame.display.update()
+        updated_rects = self.panel.draw()
+
+        if updated_rects:
+            pygame.display.update(updated_rects)
 
 
     def play_sounds(self) -> None:
@@ -117,11 +212,15 @@ class Key(Enum):
     KEY_PLAY_PAUSE = 16
     KEY_STEP = 17
     KEY_RESET = 18
+    KEY_REWIND = 19
+    KEY_STEP_BACK = 20
     
 CONTROLS_MAP = {
     pygame.K_F1: Key.KEY_PLAY_PAUSE,
     pygame.K_F2: Key.KEY_STEP,
     pygame.K_F3: Key.KEY_RESET,
+    pygame.K_F4: Key.KEY_STEP_BACK,
+    pygame.K_BACKSPACE: Key.KEY_REWIND,
     pygame.K_x: Key.KEY_0,
     pygame.K_1: Key.KEY_1,
     pygame.K_2: Key.KEY_2,
@@ -142,8 +241,14 @@ CONTROLS_MAP = {
 
 
 if __name__ == '__main__':
-    rom_filepath = sys.argv[1] if len(sys.argv) > 1 else None
-    rom = chip8.Rom(rom_filepath)
+    parser = argparse.ArgumentParser(description='CHIP-8 interpreter and debugger.')
+    parser.add_argument('rom', nargs='?', help='ROM file to load')
+    parser.add_argument('--speed', type=int, default=CHIP8_STEPS_PER_SECOND, help='instructions per second')
+    parser.add_argument('--rewind', type=int, default=REWIND_SECONDS, help='seconds of play kept for rewinding (0 to disable)')
+    parser.add_argument('--no-journal', action='store_true', help='disable stepping back, for speeds too high to record every instruction')
+    args = parser.parse_args()
+
+    rom = chip8.Rom(args.rom)
 
-    engine = Engine(rom)
+    engine = Engine(rom, args.speed, args.rewind, not args.no_journal)
     engine.run()
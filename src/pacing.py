@@ -0,0 +1,77 @@
+import time
+
+from constants import *
+
+
+class FramePacer:
+
+    def __init__(self, steps_per_second: int, frames_per_second: int = FRAMES_PER_SECOND) -> None:
+        self.steps_per_second = steps_per_second
+        self.frame_time = 1 / frames_per_second
+
+        # Emulated time owed to the CHIP-8, never more than a few frames so a slow host doesn't spiral:
+        self.owed_time = 0.0
+        self.max_owed_time = FRAME_PACER_MAX_FRAMES_BEHIND * self.frame_time
+        self.last_frame_time: float = None
+
+        self.behind = False
+        self.skipped_frames = 0
+
+        self.report_start_time: float = None
+        self.report_steps = 0
+        self.achieved_steps_per_second = 0.0
+
+
+    def steps_for_frame(self) -> int:
+        now = time.monotonic()
+
+        if self.last_frame_time is None:
+            self.last_frame_time = now
+            self.report_start_time = now
+
+        elapsed = now - self.last_frame_time
+        self.last_frame_time = now
+
+        self.owed_time = min(self.owed_time + elapsed, self.max_owed_time)
+        self.behind = elapsed > FRAME_PACER_LATE_FRAME_RATIO * self.frame_time
+
+        steps = int(self.owed_time * self.steps_per_second)
+        self.owed_time -= steps / self.steps_per_second
+
+        return steps
+
+
+    def should_draw(self) -> bool:
+        # Drawing is skipped when the host is falling behind, but never for too many frames in a row:
+
+        if self.behind and self.skipped_frames < FRAME_PACER_MAX_SKIPPED_FRAMES:
+            self.skipped_frames += 1
+            return False
+
+        self.skipped_frames = 0
+        return True
+
+
+    def record(self, steps: int) -> bool:
+        # Adds executed steps to the achieved rate, and returns whether a new rate was measured:
+
+        self.report_steps += steps
+        elapsed = self.last_frame_time - self.report_start_time
+
+        if elapsed < FRAME_PACER_REPORT_INTERVAL:
+            return False
+
+        self.achieved_steps_per_second = self.report_steps / elapsed
+        self.report_start_time = self.last_frame_time
+        self.report_steps = 0
+
+        return True
+
+
+    def reset(self) -> None:
+        self.owed_time = 0.0
+        self.last_frame_time = time.monotonic()
+
+        self.report_start_time = self.last_frame_time
+        self.report_steps = 0
+        self.achieved_steps_per_second = 0.0
@@ -0,0 +1,118 @@
+from __future__ import annotations
+from array import array
+import json
+import time
+from typing import TYPE_CHECKING, Dict
+
+from instruction import OperationType, decode_instruction
+from tools import *
+
+if TYPE_CHECKING:
+    from chip8 import Chip8
+
+
+class Profiler:
+
+    def __init__(self, chip8: Chip8) -> None:
+        self.chip8 = chip8
+
+        # Counters indexed by OperationType value, and by address for the hot spots:
+        self.counts = array('Q', bytes(8 * len(OperationType)))
+        self.seconds = array('d', bytes(8 * len(OperationType)))
+        self.address_counts = array('Q', bytes(8 * chip8.memory.size))
+
+
+    def run(self, cycles: int, keys_pressed: int = 0) -> int:
+        # An instrumented copy of Chip8.run(), one instruction at a time, so the plain loop doesn't pay for any of this:
+
+        chip8 = self.chip8
+        chip8.keys_pressed = keys_pressed
+
+        words = chip8.words
+        ram = chip8.memory.addresses
+        size = chip8.memory.size
+        execute = chip8.execute
+
+        counts = self.counts
+        seconds = self.seconds
+        address_counts = self.address_counts
+        clock = time.perf_counter
+
+        for _ in range(cycles):
+            address = words[CHIP8_WORD_PC]
+            words[CHIP8_WORD_PC] = (address + 2) % size
+            instruction = decode_instruction(ram[address], ram[(address + 1) % size])
+
+            start = clock()
+            execute(instruction)
+            elapsed = clock() - start
+
+            operation = instruction.type.value
+            counts[operation] += 1
+            seconds[operation] += elapsed
+            address_counts[address] += 1
+
+            chip8.previous_keys_pressed = keys_pressed
+            chip8.current_step += 1
+
+        chip8.sync_timers()
+
+        return cycles
+
+
+    def reset(self) -> None:
+        for counters in (self.counts, self.seconds, self.address_counts):
+            counters[:] = array(counters.typecode, bytes(counters.itemsize * len(counters)))
+
+
+    @property
+    def instructions(self) -> int:
+        return sum(self.counts)
+
+
+    def operations(self) -> Dict[OperationType, Dict]:
+        # Counts and host time of the operation types that were executed, most executed first:
+
+        executed = [operation for operation in OperationType if self.counts[operation.value] > 0]
+        executed.sort(key=lambda operation: self.counts[operation.value], reverse=True)
+
+        return {operation: {'count': self.counts[operation.value], 'seconds': self.seconds[operation.value]} for operation in executed}
+
+
+    def hot_addresses(self, limit: int = None) -> Dict[int, int]:
+        addresses = [address for address, count in enumerate(self.address_counts) if count > 0]
+        addresses.sort(key=lambda address: self.address_counts[address], reverse=True)
+
+        return {address: self.address_counts[address] for address in addresses[:limit]}
+
+
+    def to_dict(self, limit: int = None) -> Dict:
+        return {
+            'instructions': self.instructions,
+            'operations': {operation.name: counters for operation, counters in self.operations().items()},
+            'addresses': {to_hex(address, 3): count for address, count in self.hot_addresses(limit).items()},
+        }
+
+
+    def to_json(self, limit: int = None) -> str:
+        return json.dumps(self.to_dict(limit), indent=2)
+
+
+    def report(self, limit: int = 20) -> str:
+        total = max(self.instructions, 1)
+        memory = self.chip8.memory
+
+        lines = [f'{"Operation":<28} {"Count":>12} {"%":>6} {"Time (ms)":>10} {"ns/op":>8}']
+
+        for operation, counters in self.operations().items():
+            count, seconds = counters['count'], counters['seconds']
+            lines.append(f'{operation.name:<28} {count:>12} {100 * count / total:>6.2f} {1000 * seconds:>10.2f} {1e9 * seconds / count:>8.0f}')
+
+        lines.append('')
+        lines.append(f'{"Address":<8} {"Count":>12} {"%":>6}  Instruction')
+
+        for address, count in self.hot_addresses(limit).items():
+            instruction = decode_instruction(memory[address], memory[address + 1])
+            lines.append(f'{to_hex(address, 3):<8} {count:>12} {100 * count / total:>6.2f}  {instruction.asm}')
+
+        return '\n'.join(lines)
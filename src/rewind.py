@@ -0,0 +1,104 @@
+from collections import deque
+from typing import Deque, List
+import zlib
+
+from constants import *
+
+
+class Segment:
+
+    def __init__(self, keyframe: bytes) -> None:
+        # A compressed full snapshot, followed by the compressed XORs of the next snapshots against it:
+        self.keyframe = keyframe
+        self.deltas: List[bytes] = []
+
+
+    @property
+    def frames(self) -> int:
+        return 1 + len(self.deltas)
+
+
+class RewindBuffer:
+
+    def __init__(self, capacity: int, keyframe_interval: int = REWIND_KEYFRAME_INTERVAL) -> None:
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+
+        self.segments: Deque[Segment] = deque()
+        self.frames = 0
+        self.memory_used = 0
+
+        # Keyframe of the newest segment as an integer, so deltas are a single XOR of two integers:
+        self.reference: int = None
+
+
+    def record(self, snapshot: bytes) -> None:
+        if self.capacity <= 0:
+            return
+
+        if not self.segments or self.segments[-1].frames >= self.keyframe_interval:
+            segment = Segment(zlib.compress(snapshot, REWIND_COMPRESSION_LEVEL))
+
+            self.segments.append(segment)
+            self.reference = int.from_bytes(snapshot, 'little')
+            self.memory_used += len(segment.keyframe)
+        else:
+            delta = zlib.compress(self.xor(snapshot), REWIND_COMPRESSION_LEVEL)
+
+            self.segments[-1].deltas.append(delta)
+            self.memory_used += len(delta)
+
+        self.frames += 1
+
+        # Whole segments are dropped from the oldest end, as long as the rest still covers the capacity:
+
+        while self.frames - self.segments[0].frames >= self.capacity:
+            self.drop_oldest_segment()
+
+
+    def rewind(self) -> bytes:
+        # Removes the newest snapshot and returns it, or None if there is nothing left:
+
+        if self.frames == 0:
+            return None
+
+        segment = self.segments[-1]
+
+        if segment.deltas:
+            delta = segment.deltas.pop()
+            snapshot = self.xor(zlib.decompress(delta))
+            self.memory_used -= len(delta)
+        else:
+            snapshot = zlib.decompress(segment.keyframe)
+            self.segments.pop()
+            self.memory_used -= len(segment.keyframe)
+            self.reference = None
+
+        self.frames -= 1
+
+        return snapshot
+
+
+    def xor(self, data: bytes) -> bytes:
+        if self.reference is None:
+            self.reference = int.from_bytes(zlib.decompress(self.segments[-1].keyframe), 'little')
+
+        return (int.from_bytes(data, 'little') ^ self.reference).to_bytes(len(data), 'little')
+
+
+    def drop_oldest_segment(self) -> None:
+        segment = self.segments.popleft()
+
+        self.frames -= segment.frames
+        self.memory_used -= len(segment.keyframe) + sum(len(delta) for delta in segment.deltas)
+
+
+    def clear(self) -> None:
+        self.segments.clear()
+        self.frames = 0
+        self.memory_used = 0
+        self.reference = None
+
+
+    def __len__(self) -> int:
+        return self.frames
@@ -0,0 +1,294 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, List, Set
+
+from analysis import analyze
+from instruction import Instruction, OperationType, OperandType, decode_instruction
+from tools import *
+
+if TYPE_CHECKING:
+    from chip8 import Chip8
+
+
+# Instructions that always end a basic block, because they change the program counter or write memory:
+BLOCK_TERMINATORS = {
+    OperationType.RETURN_FROM_SUBROUTINE,
+    OperationType.ABSOLUTE_JUMP,
+    OperationType.CALL_SUBROUTINE,
+    OperationType.SKIP_IF_EQUALS,
+    OperationType.SKIP_IF_NOT_EQUALS,
+    OperationType.ABSOLUTE_JUMP_WITH_OFFSET,
+    OperationType.SKIP_IF_KEY_PRESSED,
+    OperationType.SKIP_IF_KEY_NOT_PRESSED,
+    OperationType.WAIT_FOR_KEY,
+    OperationType.BCD_CONVERSION,
+    OperationType.DUMP_REGISTERS_TO_MEMORY,
+}
+
+# Instructions that depend on per-step state (timers and key changes), so they can only open a block:
+BLOCK_LEADERS = {
+    OperationType.GET_DELAY_TIMER,
+    OperationType.SET_DELAY_TIMER,
+    OperationType.SET_SOUND_TIMER,
+    OperationType.WAIT_FOR_KEY,
+}
+
+
+class Block:
+
+    def __init__(self, start: int, end: int, length: int, draws: bool, calls: bool, source: str, function: Callable[[Chip8], None]) -> None:
+        self.start = start
+        self.end = end
+        self.length = length
+        self.draws = draws
+        self.calls = calls
+        self.source = source
+        self.function = function
+
+
+    def covers(self, address: int, length: int) -> bool:
+        return address < self.end and self.start < address + length
+
+
+    def covers_any(self, addresses: Set[int]) -> bool:
+        return any(self.start <= address < self.end for address in addresses)
+
+
+class BlockTranslator:
+
+    def __init__(self, chip8: Chip8) -> None:
+        self.chip8 = chip8
+        self.blocks: Dict[int, Block] = {}
+
+        # Blocks end where static analysis of the ROM found another one starting, so a jump into a loop or a return from
+        # a call finds its own block instead of translating a copy of the tail of one it's in the middle of. Ending a
+        # block early is always safe, so code the program rewrites at runtime only makes these less useful:
+        self.leaders = analyze(chip8.memory).leaders
+
+        self.chip8.memory.add_write_listener(self.invalidate)
+
+
+    def block_at(self, address: int) -> Block:
+        block = self.blocks.get(address)
+
+        if block is None:
+            block = self.translate(address)
+            self.blocks[address] = block
+
+        return block
+
+
+    def invalidate(self, address: int, length: int) -> None:
+        if length < 2 * CHIP8_MAX_BLOCK_LENGTH:
+            candidates = range(address - 2 * CHIP8_MAX_BLOCK_LENGTH + 1, address + length)
+        else:
+            candidates = list(self.blocks.keys())
+
+        for start in candidates:
+            block = self.blocks.get(start)
+
+            if block is not None and block.covers(address, length):
+                del self.blocks[start]
+
+
+    def translate(self, start: int) -> Block:
+        memory = self.chip8.memory
+        emitter = BlockEmitter(self.chip8)
+
+        address = start
+        length = 0
+        draws = False
+        calls = False
+
+        while length < CHIP8_MAX_BLOCK_LENGTH:
+            instruction = decode_instruction(memory[address], memory[address + 1])
+
+            if length > 0 and (instruction.type in BLOCK_LEADERS or address in self.leaders):
+                break
+
+            next_address = (address + 2) % memory.size
+            emitter.emit(instruction, address, next_address)
+
+            draws = draws or instruction.type in (OperationType.DRAW, OperationType.CLEAR_SCREEN)
+            calls = instruction.type == OperationType.CALL_SUBROUTINE
+
+            length += 1
+            address += 2
+
+            if instruction.type in BLOCK_TERMINATORS or next_address != address:
+                break
+
+        emitter.finish(address % memory.size)
+
+        return Block(start, address, length, draws, calls, emitter.source, emitter.compile())
+
+
+class BlockEmitter:
+
+    def __init__(self, chip8: Chip8) -> None:
+        self.chip8 = chip8
+
+        self.lines: List[str] = []
+        self.namespace = {}
+
+        self.loaded: Set[int] = set()
+        self.dirty: Set[int] = set()
+        self.pc_written = False
+
+
+    @property
+    def source(self) -> str:
+        body = '\n'.join(f'    {line}' for line in self.lines)
+        return f'def block(c):\n    V = c.v\n    W = c.words\n{body}\n'
+
+
+    def compile(self) -> Callable[[Chip8], None]:
+        exec(self.source, self.namespace)
+        return self.namespace['block']
+
+
+    def read(self, register: int) -> str:
+        if register not in self.loaded:
+            self.lines.append(f'v{register} = V[{register}]')
+            self.loaded.add(register)
+
+        return f'v{register}'
+
+
+    def write(self, register: int, expression: str) -> None:
+        self.lines.append(f'v{register} = {expression}')
+        self.loaded.add(register)
+        self.dirty.add(register)
+
+
+    def flush(self) -> None:
+        for register in sorted(self.dirty):
+            self.lines.append(f'V[{register}] = v{register}')
+
+        self.dirty.clear()
+
+
+    def set_pc(self, expression: str) -> None:
+        self.lines.append(f'W[{CHIP8_WORD_PC}] = {expression}')
+        self.pc_written = True
+
+
+    def call_handler(self, instruction: Instruction, address: int, next_address: int) -> None:
+        handler_name = f'handler_{address:03x}'
+        instruction_name = f'instruction_{address:03x}'
+
+        self.namespace[handler_name] = self.chip8.handlers[instruction.type]
+        self.namespace[instruction_name] = instruction
+
+        self.flush()
+
+        if instruction.type in BLOCK_TERMINATORS:
+            self.set_pc(f'0x{next_address:03x}')
+
+        self.lines.append(f'{handler_name}({instruction_name})')
+        self.loaded.clear()
+
+
+    def emit(self, instruction: Instruction, address: int, next_address: int) -> None:
+        operation = instruction.type
+        operands = instruction.operands
+        skip_address = (next_address + 2) % self.chip8.memory.size
+
+        if operation in (OperationType.UNKNOWN, OperationType.MACHINE_CODE):
+            pass
+
+        elif operation == OperationType.ABSOLUTE_JUMP:
+            self.flush()
+            self.set_pc(f'0x{operands[0].value:03x}')
+
+        elif operation == OperationType.CALL_SUBROUTINE:
+            self.flush()
+            self.lines.append(f'c.stack.push(0x{next_address:03x})')
+            self.set_pc(f'0x{operands[0].value:03x}')
+
+        elif operation in (OperationType.SKIP_IF_EQUALS, OperationType.SKIP_IF_NOT_EQUALS):
+            first = self.read(operands[0].value)
+
+            if operands[1].type == OperandType.LITERAL:
+                second = f'0x{operands[1].value:02x}'
+            else:
+                second = self.read(operands[1].value)
+
+            comparison = '==' if operation == OperationType.SKIP_IF_EQUALS else '!='
+
+            self.flush()
+            self.set_pc(f'0x{skip_address:03x} if {first} {comparison} {second} else 0x{next_address:03x}')
+
+        elif operation == OperationType.COPY and operands[0].type == OperandType.REGISTER:
+            if operands[1].type == OperandType.LITERAL:
+                self.write(operands[0].value, f'0x{operands[1].value:02x}')
+            else:
+                self.write(operands[0].value, self.read(operands[1].value))
+
+        elif operation == OperationType.COPY and operands[0].type == OperandType.INDEX:
+            self.lines.append(f'W[{CHIP8_WORD_INDEX}] = 0x{operands[1].value:03x}')
+
+        elif operation == OperationType.ADD_WITHOUT_CARRY and operands[0].type == OperandType.REGISTER:
+            self.write(operands[0].value, f'({self.read(operands[0].value)} + 0x{operands[1].value:02x}) & 0xff')
+
+        elif operation == OperationType.ADD_WITHOUT_CARRY and operands[0].type == OperandType.INDEX:
+            self.lines.append(f'W[{CHIP8_WORD_INDEX}] = (W[{CHIP8_WORD_INDEX}] + {self.read(operands[1].value)}) & 0xffff')
+
+        elif operation in (OperationType.BITWISE_OR, OperationType.BITWISE_AND, OperationType.BITWISE_XOR):
+            operator = {OperationType.BITWISE_OR: '|', OperationType.BITWISE_AND: '&', OperationType.BITWISE_XOR: '^'}[operation]
+            x, y = operands[0].value, operands[1].value
+            self.write(x, f'{self.read(x)} {operator} {self.read(y)}')
+
+        elif operation == OperationType.ADD_WITH_CARRY:
+            x, y = operands[0].value, operands[1].value
+            self.lines.append(f'result = {self.read(x)} + {self.read(y)}')
+            self.write(x, 'result & 0xff')
+            self.write(0xf, f'1 if result > 0xff else {self.read(0xf)}')
+
+        elif operation == OperationType.SUBTRACTION_DIRECT:
+            x, y = operands[0].value, operands[1].value
+            self.write(0xf, f'1 if {self.read(x)} >= {self.read(y)} else 0')
+            self.write(x, f'({self.read(x)} - {self.read(y)}) & 0xff')
+
+        elif operation == OperationType.SUBTRACTION_REVERSE:
+            x, y = operands[0].value, operands[1].value
+            self.write(0xf, f'0 if {self.read(x)} >= {self.read(y)} else 1')
+            self.write(x, f'({self.read(y)} - {self.read(x)}) & 0xff')
+
+        elif operation == OperationType.SHIFT_RIGHT:
+            x = operands[0].value
+            self.write(0xf, f'{self.read(x)} & 0x01')
+            self.write(x, f'({self.read(x)} >> 1) & 0xff')
+
+        elif operation == OperationType.SHIFT_LEFT:
+            x = operands[0].value
+            self.write(0xf, f'{self.read(x)} >> 7')
+            self.write(x, f'({self.read(x)} << 1) & 0xff')
+
+        elif operation == OperationType.RANDOM_NUMBER:
+            self.write(operands[0].value, f'c.random.randint(0, 0xff) & 0x{operands[1].value:02x}')
+
+        elif operation == OperationType.GET_DELAY_TIMER:
+            self.lines.append('c.sync_timers()')
+            self.write(operands[0].value, 'c.delay_timer.value')
+
+        elif operation == OperationType.SET_DELAY_TIMER:
+            self.lines.append('c.sync_timers()')
+            self.lines.append(f'c.delay_timer.set_value({self.read(operands[0].value)})')
+
+        elif operation == OperationType.SET_SOUND_TIMER:
+            self.lines.append('c.sync_timers()')
+            self.lines.append(f'c.sound_timer.set_value({self.read(operands[0].value)})')
+
+        elif operation == OperationType.LOAD_FONT:
+            first_char = self.chip8.memory.first_char
+            self.lines.append(f'W[{CHIP8_WORD_INDEX}] = 0x{first_char:02x} + 5 * ({self.read(operands[0].value)} & 0x0f)')
+
+        else:
+            self.call_handler(instruction, address, next_address)
+
+
+    def finish(self, next_address: int) -> None:
+        self.flush()
+
+        if not self.pc_written:
+            self.set_pc(f'0x{next_address:03x}')
@@ -1,13 +1,63 @@
-from typing import List
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Tuple
 
 import numpy as np
 import pygame
 
+from analysis import analyze
 import chip8
 from constants import *
+from disassembler import Disassembler, format_data_word
 from tools import *
 
 
+NEVER_DRAWN = object()
+
+
+class TextCache:
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.surfaces: Dict[Tuple[str, Tuple[int, int, int], pygame.font.Font], pygame.Surface] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def render(self, font: pygame.font.Font, text: str, color: Tuple[int, int, int]) -> pygame.Surface:
+        key = (text, color, font)
+        surface = self.surfaces.get(key)
+
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, False, color)
+        self.surfaces[key] = surface
+
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+
+        return surface
+
+
+    def clear(self) -> None:
+        self.surfaces.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+text_cache = TextCache(TEXT_CACHE_SIZE)
+
+
 class Drawable:
 
     def __init__(self, screen: pygame.Surface, font: pygame.font = None, x: int = None, y: int = None, w: int = None, h: int = None) -> None:
@@ -18,6 +68,8 @@ class Drawable:
         self.w = w
         self.h = h
 
+        self.drawn_state: Hashable = NEVER_DRAWN
+
 
     @property
     def top(self) -> int:
@@ -39,10 +91,37 @@ class Drawable:
         return self.x
 
 
+    @property
+    def rect(self) -> pygame.Rect:
+        return pygame.Rect(self.x, self.y, self.w, self.h)
+
+
     def draw(self) -> None:
         raise NotImplementedError()
 
 
+    def state(self) -> Hashable:
+        # Everything the drawable shows, so it's only redrawn when this changes:
+        raise NotImplementedError()
+
+
+    def draw_if_changed(self) -> pygame.Rect:
+        state = self.state()
+
+        if state == self.drawn_state:
+            return None
+
+        self.screen.fill(BACKGROUND_COLOR, self.rect)
+        self.draw()
+        self.drawn_state = state
+
+        return self.rect
+
+
+    def invalidate(self) -> None:
+        self.drawn_state = NEVER_DRAWN
+
+
     def draw_text(self, lines: List[str], x_offset=0, y_offset=0, highlights: List[int] = None) -> None:
         highlights = [] if highlights is None else highlights
 
@@ -50,7 +129,7 @@ class Drawable:
             color = HIGHLIGHT_COLOR if i in highlights else PRIMARY_COLOR
 
             self.screen.blit(
-                self.font.render(line, False, color),
+                text_cache.render(self.font, line, color),
                 (MARGIN + self.x + x_offset, MARGIN + self.y + i * FONT_SIZE + y_offset))
 
 
@@ -186,9 +265,21 @@ class Panel(Drawable):
         self.sound_player = SoundPlayer(chip8.sound_timer)
 
 
-    def draw(self) -> None:
+    def draw(self) -> List[pygame.Rect]:
+        updated_rects = []
+
         for drawable in self.drawables:
-            drawable.draw()
+            rect = drawable.draw_if_changed()
+
+            if rect is not None:
+                updated_rects.append(rect)
+
+        return updated_rects
+
+
+    def invalidate(self) -> None:
+        for drawable in self.drawables:
+            drawable.invalidate()
 
 
     def play_sounds(self) -> None:
@@ -203,48 +294,49 @@ class GameScreen(Drawable):
         self.chip8_display = chip8_display
         self.grid = grid
 
+        self.palette = np.array([PIXEL_OFF_COLOR, PIXEL_ON_COLOR], dtype=np.uint8)
+        self.surface = pygame.Surface((chip8_display.width, chip8_display.height), 0, 32)
+        self.scaled_surface = pygame.Surface((self.w, self.h), 0, 32)
+        self.grid_overlay = self.render_grid() if grid else None
 
-    def draw(self) -> None:
-        for y in range(self.chip8_display.height):
-            for x in range(self.chip8_display.width):
-                rect = pygame.Rect(
-                    self.x + x * self.pixel_size,
-                    self.y + y * self.pixel_size,
-                    self.pixel_size,
-                    self.pixel_size)
 
-                color = PIXEL_ON_COLOR if self.chip8_display.get_pixel_at(x, y) else PIXEL_OFF_COLOR
+    def state(self) -> Hashable:
+        return tuple(self.chip8_display.rows)
 
-                pygame.draw.rect(self.screen, color, rect)
 
-        rect = pygame.Rect(
-            self.x,
-            self.y,
-            self.chip8_display.width * self.pixel_size,
-            self.chip8_display.height * self.pixel_size)
+    def draw(self) -> None:
+        data = np.frombuffer(self.chip8_display.to_bytes(), dtype=np.uint8)
+        pixels = np.unpackbits(data.reshape(self.chip8_display.height, -1), axis=1)
+
+        pygame.surfarray.blit_array(self.surface, self.palette[pixels.T])
+        pygame.transform.scale(self.surface, (self.w, self.h), self.scaled_surface)
+        self.screen.blit(self.scaled_surface, (self.x, self.y))
 
         if self.grid:
-            self.draw_grid()
+            self.screen.blit(self.grid_overlay, (self.x, self.y))
 
         self.draw_frame()
 
 
-    def draw_grid(self) -> None:
+    def render_grid(self) -> pygame.Surface:
+        overlay = pygame.Surface((self.w, self.h), pygame.SRCALPHA, 32)
         color = SECONDARY_COLOR
 
         for y in range(1, self.chip8_display.height):
             pygame.draw.line(
-                self.screen,
+                overlay,
                 color,
-                (self.x, y * self.pixel_size + self.y),
-                (self.chip8_display.width * self.pixel_size + self.x - 1, y * self.pixel_size + self.y))
+                (0, y * self.pixel_size),
+                (self.chip8_display.width * self.pixel_size - 1, y * self.pixel_size))
 
         for x in range(1, self.chip8_display.width):
             pygame.draw.line(
-                self.screen,
+                overlay,
                 color,
-                (x * self.pixel_size + self.x, self.y),
-                (x * self.pixel_size + self.x, self.chip8_display.height * self.pixel_size + self.y - 1))
+                (x * self.pixel_size, 0),
+                (x * self.pixel_size, self.chip8_display.height * self.pixel_size - 1))
+
+        return overlay
 
 
 class MemoryView(Drawable):
@@ -264,26 +356,43 @@ class MemoryView(Drawable):
 
         self.chip8_memory = chip8_memory
         self.chip8_pc = chip8_pc
+        self.disassembler = Disassembler(chip8_memory)
+        self.analysis = analyze(chip8_memory)
+        self.labels = self.analysis.labels
 
         self.addresses_to_show = 64
 
 
+    def state(self) -> Hashable:
+        first_address = self.chip8_pc.value - self.addresses_to_show // 2 + 2
+        return (self.chip8_pc.value, tuple(self.chip8_memory.read(first_address, self.addresses_to_show - 2)))
+
+
     def draw(self) -> None:
         lines = []
         lines.append('  ADDR  DATA  ASSEMBLY')
 
+        # Addresses that start a subroutine or a jump target are marked, and ROM data the program never runs is shown as
+        # bytes rather than decoded into instructions, unless the program counter gets there after all:
+
+        memory = self.chip8_memory
+
         for i in range(-self.addresses_to_show // 2 + 2, self.addresses_to_show // 2, 2):
-            address = self.chip8_pc.value + i
+            address = (self.chip8_pc.value + i) % memory.size
 
-            if address < 0:
-                address += self.chip8_memory.size
+            if i == 0:
+                marker = '→'
+            elif address in self.labels:
+                marker = '•'
+            else:
+                marker = ' '
 
-            first_byte = self.chip8_memory[address]
-            second_byte = self.chip8_memory[address + 1]
+            if i != 0 and self.analysis.is_data(address) and self.analysis.is_data(address + 1):
+                line = format_data_word(address, memory[address], memory[address + 1])
+            else:
+                line = self.disassembler.line_at(address)
 
-            marker = '→' if i == 0 else ' '
-            instruction = chip8.Instruction(first_byte, second_byte)
-            lines.append(f'{marker}  {to_hex(address, 3)}  {instruction.hex}  {instruction.asm}')
+            lines.append(f'{marker}  {line}')
 
         self.draw_text(lines, highlights=[16])
         self.draw_frame()
@@ -296,6 +405,10 @@ class IndexView(Drawable):
         self.chip8_index = chip8_index
 
 
+    def state(self) -> Hashable:
+        return self.chip8_index.value
+
+
     def draw(self) -> None:
         lines = [
             'Index register',
@@ -325,6 +438,10 @@ class TimerView(Drawable):
         self.chip8_timer = chip8_timer
 
 
+    def state(self) -> Hashable:
+        return self.chip8_timer.value
+
+
     def draw(self) -> None:
         lines = [
             self.name,
@@ -342,6 +459,10 @@ class RegistersView(Drawable):
         self.chip8_registers = chip8_registers
 
 
+    def state(self) -> Hashable:
+        return tuple(register.value for register in self.chip8_registers)
+
+
     def draw(self) -> None:
         register_count = len(self.chip8_registers)
         lines = [f' V{to_hex(i, 1)} {to_hex(register.value, 2)}' for i, register in enumerate(self.chip8_registers)]
@@ -360,6 +481,10 @@ class StackView(Drawable):
         self.chip8_stack = chip8_stack
 
 
+    def state(self) -> Hashable:
+        return tuple(self.chip8_stack[i] for i in range(len(self.chip8_stack)))
+
+
     def draw(self) -> None:
         lines = [f' {to_hex(self.chip8_stack[i], 2)}' for i in range(len(self.chip8_stack))]
 
@@ -377,6 +502,10 @@ class Label(Drawable):
         self.lines = text.splitlines()
 
 
+    def state(self) -> Hashable:
+        return None
+
+
     def draw(self) -> None:
         self.draw_text(self.lines)
         self.draw_frame()